@@ -1,16 +1,37 @@
 import os
+import sys
 import json
+import re
+import argparse
 import time
 import signal
-import psutil
+import sqlite3
+import hashlib
+import zlib
+import array
+import mmap
+import struct
+import threading
+import tempfile
 import subprocess
+import ctypes
+from functools import partial
+from bisect import bisect_right
+from collections import namedtuple
+from queue import Queue, Empty
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
 
 APP_TITLE = "Simple MIDI Player v2.0.3 (Instruments + BPM/Key)"
 CONFIG_NAME = "mhp_config.json"
+CONFIG_SAVE_DELAY_MS = 500  # 設定の書き込みをまとめる待ち時間
+ANALYSIS_CACHE_NAME = "mhp_analysis_cache.sqlite"
 DRIVER_CHOICES = ["dsound", "wasapi", "portaudio"]
+# server はイベントを Python のスレッドから送るので、OS のスレッド切り替え次第で 1ms 前後の揺れが残る
+# （タイマー粒度の 15.6ms 単位の遅れは ServerBackend が perf_counter で詰めて待つので出ない）
+ENGINE_CHOICES = ["process", "inprocess", "server"]
 
 # ---- Try to import mido (for MIDI parsing) ----
 try:
@@ -19,6 +40,23 @@ try:
 except Exception:
     _HAVE_MIDO = False
 
+# ---- Try to import psutil (Windows で numpy が無いときの一時停止だけに使う) ----
+try:
+    import psutil
+    _HAVE_PSUTIL = True
+except Exception:
+    _HAVE_PSUTIL = False
+
+# ---- Try to import numpy (for the columnar event table) ----
+try:
+    import numpy as np
+    _HAVE_NUMPY = True
+except Exception:
+    _HAVE_NUMPY = False
+
+# 解析はどちらか一方があれば動く（numpy 優先）
+_HAVE_ANALYZER = _HAVE_NUMPY or _HAVE_MIDO
+
 # ---- GM Program Names (0-127) ----
 GM_PROGRAMS = [
     "Acoustic Grand Piano","Bright Acoustic Piano","Electric Grand Piano","Honky-tonk Piano","Electric Piano 1","Electric Piano 2","Harpsichord","Clavinet",
@@ -55,11 +93,23 @@ def load_config():
         return {}
 
 def save_config(data):
+    # 同じフォルダの一時ファイルに書いてから置き換える（途中で落ちても壊れない）
+    path = config_path()
+    tmp = None
     try:
-        with open(config_path(), "w", encoding="utf-8") as f:
+        fd, tmp = tempfile.mkstemp(prefix=".mhp_config_", suffix=".tmp", dir=os.path.dirname(path))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+        tmp = None
     except Exception:
         pass
+    finally:
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
 
 # ---------------- Simple tooltip ----------------
 class Tooltip:
@@ -92,24 +142,52 @@ class SimpleMIDIPlayer200Design:
     def __init__(self, root):
         self.root = root
         self.root.title(APP_TITLE)
-        self.root.geometry("1040x600")
-        self.root.minsize(940, 540)
-        self.proc = None
+        self.root.geometry("1040x700")
+        self.root.minsize(940, 640)
+        self.backend = None  # 再生エンジン（ProcessBackend / InProcessBackend / ServerBackend）
+        self.clock = PlaybackClock()  # 再生位置。表示や他の部品はここを見る
+        self._base_tick = 0   # 再生中のファイルの tick 0 が元の曲の何 tick 目か（途中から再生した場合）
+        self._finish_waiters = []  # finished() が返した Future
+        self._finish_lock = threading.Lock()
         self.running = False
         self.paused = False
 
-        # Load config
+        # Load config（以降はメモリ上の self.cfg を変更して _schedule_save で書き出す）
         self.cfg = load_config()
+        self._save_job = None
         self.sf2_path = self.cfg.get("soundfont")
         self.fs_exe_path = self.cfg.get("fluidsynth")
         self.audio_driver = tk.StringVar(value=self.cfg.get("audio_driver") or DRV_DEFAULT())
         self.gain = tk.DoubleVar(value=float(self.cfg.get("gain", 0.8)))
+        self.engine = tk.StringVar(value=self.cfg.get("engine") or "process")
 
         self.last_midi_dir = self.cfg.get("last_midi_dir") or os.getcwd()
         self.last_sf2_dir = self.cfg.get("last_sf2_dir") or os.getcwd()
         self.last_fs_dir = self.cfg.get("last_fs_dir") or os.getcwd()
 
         self.selected_midi_path = None
+        self.analysis = None  # 選択中MIDIの解析結果 (MidiAnalysis)
+        self.analysis_cache = None
+        if self.cfg.get("analysis_cache", True):
+            self.analysis_cache = AnalysisCache(
+                max_bytes=int(self.cfg.get("analysis_cache_mb", 64)) * 1024 * 1024,
+                use_hash=bool(self.cfg.get("analysis_cache_hash", False)),
+            )
+        self.analysis_worker = AnalysisWorker(self.root, self.analysis_cache)
+        self.seek_index = None   # 選択中MIDIの SeekIndex（numpy があれば再生開始時に裏で作る）
+        self._instruments_at = 0.0  # 楽器一覧をこの位置（秒）の状態で出す。0 なら曲全体
+        self._pending_start = None  # SeekIndex ができるのを待っている start の (midi, from_sec)
+        self.seek_worker = AnalysisWorker(self.root)
+        self._seek_tmps = []     # シーク用に書き出した一時 .mid（消せなかったものは次回また消す）
+
+        # プレイリスト（連続再生）
+        self.playlist = [p for p in (self.cfg.get("playlist") or []) if isinstance(p, str)]
+        self.playlist_pos = -1   # 再生中の曲の位置（プレイリスト外なら -1）
+        self.continuous = tk.BooleanVar(value=bool(self.cfg.get("continuous", True)))
+        self._preloaded = None   # (midi_path, MidiAnalysis, SeekIndex) 次の曲の先読み結果
+        self._track_changes = Queue()  # server エンジンが切り替えた曲のパス（<<TrackChanged>> 1回につき1つ）
+        self._driver_failures = Queue()  # (鳴らし続けているドライバ, 開けなかったドライバ, 理由)（<<DriverFailed>> 1回につき1つ）
+        self.preload_worker = AnalysisWorker(self.root, self.analysis_cache)
 
         # Build UI
         self._init_style()
@@ -120,8 +198,12 @@ class SimpleMIDIPlayer200Design:
         self.root.bind("<space>", self._toggle_pause_key)
         self.root.bind("<Control-o>", lambda e: self.pick_midi())
         self.root.bind("<Control-s>", lambda e: self.pick_sf2())
+        self.root.bind("<<SongEnded>>", self._on_song_ended)
+        self.root.bind("<<TrackChanged>>", self._on_track_changed)
+        self.root.bind("<<DriverFailed>>", self._on_driver_failed)
 
         self._set_status("準備OK")
+        self._tick_clock()
 
     # ---------- Style / Dark mode ----------
     def _init_style(self):
@@ -158,6 +240,9 @@ class SimpleMIDIPlayer200Design:
         self.style.configure("TLabelframe.Label", background=bg, foreground=fg)
         self.style.configure("TButton", padding=(10, 4))
         self.style.map("TButton", background=[("active", acc)])
+        box = getattr(self, "playlist_box", None)  # tk.Listbox は ttk のスタイルが効かない
+        if box is not None:
+            box.configure(bg=card, fg=fg, selectbackground=acc, selectforeground=fg)
 
     # ---------- UI ----------
     def _build_ui(self):
@@ -196,7 +281,15 @@ class SimpleMIDIPlayer200Design:
         ttk.Label(r, text="Audio Driver").pack(side="left")
         self.driver_cmb = ttk.Combobox(r, values=DRIVER_CHOICES, textvariable=self.audio_driver, width=12, state="readonly")
         self.driver_cmb.pack(side="left", padx=6)
-        self.driver_cmb.bind("<<ComboboxSelected>>", lambda e: self._persist_controls())
+        self.driver_cmb.bind("<<ComboboxSelected>>", lambda e: self._on_driver_change())
+
+        r = ttk.Frame(set_card); r.pack(fill="x", pady=4)
+        ttk.Label(r, text="Engine").pack(side="left")
+        self.engine_cmb = ttk.Combobox(r, values=ENGINE_CHOICES, textvariable=self.engine, width=12, state="readonly")
+        self.engine_cmb.pack(side="left", padx=6)
+        self.engine_cmb.bind("<<ComboboxSelected>>", lambda e: self._persist_controls())
+        Tooltip(self.engine_cmb, "process: 曲ごとに fluidsynth を起動 / inprocess: SoundFont を常駐（pyfluidsynth）\n"
+                                 "server: fluidsynth を常駐させてコマンドで操作（発音タイミングに 1ms 前後の揺れあり）")
 
         r = ttk.Frame(set_card); r.pack(fill="x", pady=4)
         ttk.Label(r, text="Gain").pack(side="left")
@@ -216,6 +309,32 @@ class SimpleMIDIPlayer200Design:
         for w in (self.btn_play, self.btn_pause, self.btn_resume, self.btn_stop, self.btn_wait):
             w.pack(side="left", padx=6, pady=4)
 
+        # 再生位置（シーク）
+        self.start_pos = tk.StringVar(value="0:00")
+        self.btn_seek = ttk.Button(ctrl_card, text="⏩ この位置から", command=self.seek, width=14)
+        self.btn_seek.pack(side="right", padx=6, pady=4)
+        e = ttk.Entry(ctrl_card, textvariable=self.start_pos, width=8)
+        e.pack(side="right", pady=4)
+        e.bind("<Return>", lambda _e: self.seek())
+        Tooltip(e, "開始位置（秒 または 分:秒）")
+        ttk.Label(ctrl_card, text="開始位置").pack(side="right", padx=(6, 4))
+
+        # Playlist card
+        pl_card = ttk.Frame(self.root, style="Card.TFrame")
+        pl_card.pack(fill="x", padx=10, pady=(0, 8))
+        ttk.Label(pl_card, text="プレイリスト").pack(side="left", anchor="n")
+        self.playlist_box = tk.Listbox(pl_card, height=4, activestyle="none", exportselection=False)
+        self.playlist_box.pack(side="left", fill="x", expand=True, padx=6)
+        self.playlist_box.bind("<Double-Button-1>", lambda e: self._play_selected())
+        pl_btns = ttk.Frame(pl_card); pl_btns.pack(side="left")
+        ttk.Button(pl_btns, text="＋ 追加", command=self.add_to_playlist, width=10).pack(fill="x")
+        ttk.Button(pl_btns, text="－ 削除", command=self.remove_from_playlist, width=10).pack(fill="x", pady=2)
+        cb = ttk.Checkbutton(pl_btns, text="連続再生", variable=self.continuous, command=self._on_continuous_change)
+        cb.pack(anchor="w")
+        Tooltip(cb, "曲が終わったら次の曲へ。server エンジンなら次の曲を先読みして隙間なくつなぐ")
+        self._refresh_playlist()
+        self._apply_dark_mode_colors()
+
         # Bottom area: Status + Meta + Instruments
         bottom = ttk.Frame(self.root, style="Card.TFrame")
         bottom.pack(fill="both", expand=True, padx=10, pady=(0, 10))
@@ -223,13 +342,15 @@ class SimpleMIDIPlayer200Design:
         # left: status & meta & button
         left_btm = ttk.Frame(bottom); left_btm.pack(side="left", fill="both", expand=True, padx=(0,8))
         self.status = ttk.Label(left_btm, text="待機中", style="Status.TLabel"); self.status.pack(fill="x")
+        self.elapsed = ttk.Label(left_btm, text="⏱ 0:00"); self.elapsed.pack(anchor="w", pady=(6,0))
         self.song_meta = ttk.Label(left_btm, text="Tempo: -  |  TS: -  |  Key: -")
         self.song_meta.pack(anchor="w", pady=(6,0))
         ttk.Button(left_btm, text="🎼 使用楽器を解析", command=self.analyze_instruments).pack(anchor="w", pady=6)
 
         # right: instruments tree
         right_btm = ttk.Frame(bottom); right_btm.pack(side="left", fill="both", expand=True)
-        ttk.Label(right_btm, text="使用楽器（GM）").pack(anchor="w")
+        self.tree_title = ttk.Label(right_btm, text="使用楽器（GM）")
+        self.tree_title.pack(anchor="w")
         cols = ("ch","bank","prog","name")
         self.tree = ttk.Treeview(right_btm, columns=cols, show="headings", height=12)
         for c, w in zip(cols, (50,60,60,240)):
@@ -250,40 +371,82 @@ class SimpleMIDIPlayer200Design:
     def toggle_dark(self):
         self.dark.set(not self.dark.get())
         self.cfg["dark_mode"] = bool(self.dark.get())
-        save_config(self.cfg)
+        self._schedule_save()
         self._apply_dark_mode_colors()
 
     # ---------- Mechanics (2.0.0 concept) ----------
     def _finalize_ended_process(self):
-        if self.proc is not None and self.proc.poll() is not None:
-            self.proc = None
+        if self.running and self.backend is not None and self.backend.is_finished():
             self.running = False
             self.paused = False
+            self.clock.stop()
             self._apply_state("stopped")
             self._set_status("停止/終了")
+            self._resolve_finish("ended")
 
-    def _build_cmd(self, midi_path):
+    def _build_cmd(self, midi_path, shell=False):
+        driver = self.audio_driver.get().strip() or DRV_DEFAULT()
+        return build_fluidsynth_cmd(self.fs_exe_path, driver, float(self.gain.get()), self.sf2_path, midi_path, shell)
+
+    def _get_backend(self):
+        """
+        設定に合う再生エンジンを返す。inprocess は SoundFont/ドライバが変わらない限り
+        同じ Synth を使い回す（曲ごとに SF2 を読み直さない）。
+        """
+        kind = self.engine.get()
         exe = self.fs_exe_path or "fluidsynth"
         driver = self.audio_driver.get().strip() or DRV_DEFAULT()
-        gain = float(self.gain.get())
-        sf2 = self.sf2_path
-        if not sf2 or not os.path.exists(sf2):
-            raise FileNotFoundError("SoundFont(.sf2) が未選択、または見つかりません。")
-        if not midi_path or not os.path.exists(midi_path):
-            raise FileNotFoundError("MIDI ファイルが見つかりません。")
-        return [exe, "-a", driver, "-g", f"{gain:.2f}", "-ni", sf2, midi_path]
-
-    def _poll_process(self):
-        if self.proc is None:
-            return
-        if self.proc.poll() is None:
-            self.root.after(300, self._poll_process)
-            return
-        self.running = False
-        self.paused = False
-        self.proc = None
-        self._apply_state("stopped")
-        self._set_status("停止/終了")
+        key = (kind, exe, self.sf2_path, driver)
+        if self.backend is not None and self.backend.key == key:
+            return self.backend
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+        if kind in ("inprocess", "server"):
+            sf2 = self.sf2_path
+            if not sf2 or not os.path.exists(sf2):
+                raise FileNotFoundError("SoundFont(.sf2) が未選択、または見つかりません。")
+        if kind == "inprocess":
+            self.backend = InProcessBackend(exe, sf2, driver, float(self.gain.get()), self.clock)
+        elif kind == "server":
+            if not _HAVE_NUMPY:
+                raise RuntimeError("server エンジンには numpy が必要です。\n\npip install numpy")
+            self.backend = ServerBackend(exe, sf2, driver, float(self.gain.get()), self._get_seek_index, self.clock)
+        elif not _HAVE_NUMPY:
+            self.backend = ProcessBackend(self._build_cmd, self.clock)
+        elif (fluidsynth_version(exe) or (0,)) >= PLAYER_CMD_VERSION:
+            self.backend = ProcessBackend(self._build_cmd, self.clock, self._write_seek_file, self._get_seek_index)
+        else:
+            # player_stop / player_cont が無い：-ni で起動して終了コードで曲の終わりを知る（シークは一時ファイルで）
+            self.backend = ProcessBackend(self._build_cmd, self.clock, self._write_seek_file)
+        self.backend.key = key
+        self.backend.on_end = self._post_song_ended
+        self.backend.on_track = self._post_track_changed
+        self.backend.on_driver_failed = self._post_driver_failed
+        return self.backend
+
+    def _post_track_changed(self, path):
+        # server エンジンのシーケンサーが queue() した曲へ切り替えたとき。どの曲かはイベントと一緒に渡す
+        self._track_changes.put(path)
+        try:
+            self.root.event_generate("<<TrackChanged>>", when="tail")
+        except Exception:
+            pass
+
+    def _post_driver_failed(self, active, driver, reason):
+        # 裏で起動した新しいドライバの fluidsynth が立ち上がらなかったとき（古い方で鳴り続けている）
+        self._driver_failures.put((active, driver, reason))
+        try:
+            self.root.event_generate("<<DriverFailed>>", when="tail")
+        except Exception:
+            pass
+
+    def _post_song_ended(self):
+        # 再生エンジンの監視スレッドから呼ばれる。Tk へはイベントを1つ積むだけ
+        try:
+            self.root.event_generate("<<SongEnded>>", when="tail")
+        except Exception:
+            pass  # ウィンドウを閉じた後
 
     # ---------- MIDI Instrument & Meta analysis ----------
     def analyze_instruments(self):
@@ -292,83 +455,219 @@ class SimpleMIDIPlayer200Design:
         if not midi or not os.path.exists(midi):
             messagebox.showinfo("情報", "MIDI を先に選択してください。")
             return
-        if not _HAVE_MIDO:
-            messagebox.showwarning("mido が必要",
-                                   "使用楽器・テンポ/キーを解析するには mido が必要です。\n\npip install mido\n\nを実行してからお試しください。")
+        if not _HAVE_ANALYZER:
+            messagebox.showwarning("numpy または mido が必要",
+                                   "使用楽器・テンポ/キーを解析するには numpy（または mido）が必要です。\n\npip install numpy\n\nを実行してからお試しください。")
             return
 
-        try:
-            used = extract_instruments(midi)
-            meta = extract_meta(midi)
-        except Exception as e:
-            messagebox.showerror("解析エラー", str(e))
+        self._request_analysis(midi, on_error=lambda e: messagebox.showerror("解析エラー", str(e)))
+
+    def _request_analysis(self, midi, on_error=None):
+        """
+        解析をワーカースレッドに投げ、終わったら Tk スレッドで表示を更新する。
+        - 同じファイルの解析結果があれば即表示
+        - 新しい要求が来たら古い要求の結果は捨てる
+        """
+        a = self.analysis
+        if a is not None and a.path == midi:
+            self.analysis_worker.cancel()
+            self._on_analysis_done(a)
             return
+        self.song_meta.config(text="Tempo: …  |  TS: …  |  Key: …  (解析中)")
+        self.tree.delete(*self.tree.get_children())
+        self.analysis_worker.submit(midi, self._on_analysis_done, on_error or self._on_analysis_failed)
+
+    def _request_meta(self, midi):
+        """選択直後用。コンダクタートラック先頭のメタだけを読む（楽器は解析しない）。"""
+        a = self.analysis
+        if a is not None and a.path == midi:
+            self._show_meta(a)
+            return
+        self.song_meta.config(text="Tempo: …  |  TS: …  |  Key: …  (解析中)")
+        self.analysis_worker.submit(midi, self._on_meta_done, self._on_analysis_failed,
+                                    job=partial(read_midi_meta, mode="initial"))
+
+    def _on_analysis_done(self, a):
+        if a.path != self.selected_midi_path:
+            return
+        self.analysis = a
+        self._show_instruments(a)
+        self._show_meta(a)
+
+    def _on_meta_done(self, meta):
+        if meta.path != self.selected_midi_path:
+            return
+        self._show_meta(meta)
+
+    def _on_analysis_failed(self, _e):
+        self.song_meta.config(text="Tempo: -  |  TS: -  |  Key: -")
 
-        # 表示（楽器）
+    def _show_instruments(self, a):
+        if self._instruments_at > 0 and self._show_instruments_at():
+            return
+        self.tree_title.config(text="使用楽器（GM）")
+        self.tree.delete(*self.tree.get_children())
+        used = extract_instruments(a)
         if not used:
             self.tree.insert("", "end", values=("-", "-", "-", "(検出なし)"))
         else:
             for ch in sorted(used.keys()):
                 bank, prog, name = used[ch]
                 self.tree.insert("", "end", values=(ch, bank, prog, name))
-        # 表示（メタ）
+
+    def _show_instruments_at(self):
+        """シークした位置の楽器（そこまでのバンク/プログラムチェンジを反映）を出す。SeekIndex がまだなら False。"""
+        idx = self.seek_index
+        if idx is None or idx.path != self.selected_midi_path:
+            return False
+        self.tree.delete(*self.tree.get_children())
+        for ch, (bank, prog, name) in sorted(idx.instruments_at(self._instruments_at).items()):
+            self.tree.insert("", "end", values=(ch, bank, prog, name))
+        self.tree_title.config(text=f"使用楽器（GM） @ {format_time(self._instruments_at)}")
+        return True
+
+    def _show_meta(self, a):
+        meta = extract_meta(a)
         self.song_meta.config(
             text=f"Tempo: {meta['bpm']} BPM  |  TS: {meta['time_sig']}  |  Key: {meta['key']}"
                  + (f"  (+{meta['tempo_changes']} tempo changes)" if meta['tempo_changes'] else "")
         )
 
-    def start(self):
+    def start(self, from_sec=None):
         self._finalize_ended_process()
-        if self.proc:
+        if self.running:
             self.stop()
 
         # 必要なら選択
         if not self._ensure_midi_selected():
             return
         midi = self.selected_midi_path
+        if not (0 <= self.playlist_pos < len(self.playlist) and self.playlist[self.playlist_pos] == midi):
+            self.playlist_pos = self.playlist.index(midi) if midi in self.playlist else -1
+        self._refresh_playlist()
+        self._adopt_preloaded(midi)
 
-        # 再生前に解析を自動実行（midoがある場合だけ）
-        if _HAVE_MIDO:
-            try:
-                used = extract_instruments(midi)
-                meta = extract_meta(midi)
-                self.tree.delete(*self.tree.get_children())
-                for ch in sorted(used.keys()):
-                    bank, prog, name = used[ch]
-                    self.tree.insert("", "end", values=(ch, bank, prog, name))
-                self.song_meta.config(
-                    text=f"Tempo: {meta['bpm']} BPM  |  TS: {meta['time_sig']}  |  Key: {meta['key']}"
-                         + (f"  (+{meta['tempo_changes']} tempo changes)" if meta['tempo_changes'] else "")
-                )
-            except Exception:
-                pass  # 解析失敗は無視して再生継続
+        if from_sec is None:
+            from_sec = 0.0
+        self._instruments_at = from_sec
 
         try:
-            cmd = self._build_cmd(midi)
+            self._build_cmd(midi)  # SoundFont / MIDI の存在確認
         except Exception as e:
             messagebox.showerror("起動エラー", str(e))
             return
 
         try:
-            creation = (subprocess.CREATE_NEW_PROCESS_GROUP if os.name == "nt" else 0)
-            self.proc = subprocess.Popen(
-                cmd,
-                stdin=subprocess.DEVNULL,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                creationflags=creation,
-                close_fds=True,
-            )
+            backend = self._get_backend()
+            if _HAVE_NUMPY and (backend.needs_index or from_sec > 0):
+                idx = self.seek_index
+                if idx is None or idx.path != midi:
+                    self._start_when_indexed(midi, from_sec)
+                    return
+            play_path = midi
+            if from_sec > 0 and not backend.native_seek:
+                try:
+                    play_path = self._write_seek_file(midi, from_sec)
+                except Exception as e:
+                    messagebox.showerror("シークエラー", str(e))
+                    return
+            self._base_tick = 0
+            if play_path != midi and self.seek_index is not None:
+                self._base_tick = self.seek_index.tempo_map.seconds_to_tick(from_sec)
+            self.clock.reset(from_sec)  # 進め始めるのは backend（シンセの準備ができてから）
+            try:
+                backend.start(play_path, float(self.gain.get()), from_sec if backend.native_seek else 0.0)
+            except Exception:
+                self.clock.stop()
+                raise
             self.running = True
             self.paused = False
             self._apply_state("playing")
-            self._set_status(f"再生中: {os.path.basename(midi)}  | drv={self.audio_driver.get()}  gain={self.gain.get():.2f}")
-            self.root.after(300, self._poll_process)
-        except FileNotFoundError:
-            messagebox.showerror("fluidsynth が見つかりません", "PATH を通すか、[fluidsynth.exe] で実行ファイルを指定してください。")
+            pos = f" @ {format_time(from_sec)}" if from_sec > 0 else ""
+            self._set_status(f"再生中: {os.path.basename(midi)}{pos}  | drv={self.audio_driver.get()}  gain={self.gain.get():.2f}")
+            # 解析は再生開始を待たせずバックグラウンドで（numpy/midoがある場合だけ）
+            if from_sec > 0:
+                self._show_instruments_at()
+            if _HAVE_ANALYZER:
+                self._request_analysis(midi)
+            self._prepare_seek_index(midi)
+            self._preload_next()
+        except SynthNotFoundError as e:
+            messagebox.showerror("fluidsynth が見つかりません", "PATH を通すか、[fluidsynth.exe] で実行ファイルを指定してください。"
+                                 + (f"\n\n{e}" if str(e) else ""))
         except Exception as e:
             messagebox.showerror("起動エラー", str(e))
 
+    def _start_when_indexed(self, midi, from_sec):
+        """SeekIndex を seek_worker で作ってから start し直す（大きい曲でも UI を止めない）。"""
+        req = self._pending_start = (midi, from_sec)
+        self._set_status(f"準備中: {os.path.basename(midi)} …")
+        def done(idx):
+            if self._pending_start is not req:
+                return  # 停止された / 別の再生要求が来た
+            self._pending_start = None
+            self.seek_index = idx
+            if self.selected_midi_path == midi:
+                self.start(from_sec)
+        def failed(e):
+            if self._pending_start is req:
+                self._pending_start = None
+                self._set_status("停止/終了")
+                messagebox.showerror("シークエラー", str(e))
+        self.seek_worker.submit(midi, done, failed, job=build_seek_index)
+
+    # ---------- Seek ----------
+    def seek(self):
+        """開始位置の欄の時刻から再生する（再生中なら位置を移動）。"""
+        try:
+            sec = parse_time_text(self.start_pos.get())
+        except ValueError as e:
+            messagebox.showerror("開始位置エラー", str(e) or "開始位置は 秒 または 分:秒 で指定してください。")
+            return
+        self.start(from_sec=sec)
+
+    def _prepare_seek_index(self, midi):
+        """再生中に SeekIndex を裏で作っておき、以降のシークを速くする。"""
+        if not _HAVE_NUMPY or (self.seek_index is not None and self.seek_index.path == midi):
+            return
+        def done(idx):
+            if idx.path == self.selected_midi_path:
+                self.seek_index = idx
+                if self._instruments_at > 0:
+                    self._show_instruments_at()
+        self.seek_worker.submit(midi, done, lambda _e: None, job=build_seek_index)
+
+    def _get_seek_index(self, midi):
+        """SeekIndex を返す（裏で作り終わっていなければその場で作る）。"""
+        if not _HAVE_NUMPY:
+            raise RuntimeError("途中からの再生には numpy が必要です。\n\npip install numpy")
+        idx = self.seek_index
+        if idx is None or idx.path != midi:
+            idx = build_seek_index(midi)
+            self.seek_index = idx
+        return idx
+
+    def _write_seek_file(self, midi, from_sec):
+        """from_sec から始まる一時 .mid を書き出してそのパスを返す。"""
+        idx = self._get_seek_index(midi)
+        self._cleanup_seek_tmp()
+        fd, tmp = tempfile.mkstemp(prefix="mhp_seek_", suffix=".mid")
+        os.close(fd)
+        idx.write_from(from_sec, tmp)
+        self._seek_tmps.append(tmp)
+        return tmp
+
+    def _cleanup_seek_tmp(self):
+        left = []
+        for tmp in self._seek_tmps:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                left.append(tmp)  # Windows で終了直後の fluidsynth がまだ掴んでいる。次回に
+        self._seek_tmps = left
+
     def _ensure_midi_selected(self):
         p = self.selected_midi_path
         if p and os.path.exists(p):
@@ -383,18 +682,15 @@ class SimpleMIDIPlayer200Design:
         self.selected_midi_path = midi
         self.last_midi_dir = os.path.dirname(midi)
         self.cfg["last_midi_dir"] = self.last_midi_dir
-        save_config(self.cfg)
+        self._schedule_save()
         self.midi_label.config(text=self._short(midi))
         return True
 
     def pause(self):
-        if not (self.proc and self.running) or self.paused:
+        if not (self.backend and self.running) or self.paused:
             return
         try:
-            if os.name == "nt":
-                ps = psutil.Process(self.proc.pid); ps.suspend()
-            else:
-                os.kill(self.proc.pid, signal.SIGSTOP)
+            self.backend.pause()  # 時計も backend が止める
             self.paused = True
             self._apply_state("paused")
             self._set_status("一時停止中")
@@ -402,61 +698,98 @@ class SimpleMIDIPlayer200Design:
             messagebox.showerror("一時停止エラー", str(e))
 
     def resume(self):
-        if not (self.proc and self.running) or not self.paused:
+        if not (self.backend and self.running) or not self.paused:
             return
         try:
-            if os.name == "nt":
-                ps = psutil.Process(self.proc.pid); ps.resume()
-            else:
-                os.kill(self.proc.pid, signal.SIGCONT)
+            self.backend.resume()  # 時計はシンセが鳴り始めたら backend が進める
             self.paused = False
             self._apply_state("playing")
             self._set_status("再生再開")
         except Exception as e:
             messagebox.showerror("再開エラー", str(e))
 
-    def wait_until_finish(self):
-        if self.proc and self.running:
-            self._set_status("終了待ち...")
-            try:
-                self.proc.wait()
-            except Exception:
-                pass
-            self.running = False
-            self.paused = False
-            self.proc = None
-            self._apply_state("stopped")
-            self._set_status("停止/終了")
+    def wait_until_finish(self, timeout=None):
+        """
+        曲の終わりを待つ（UI は止めない）。finished() の Future を返す。
+        timeout 秒を過ぎたら待つのをやめる（再生はそのまま）。
+        """
+        if not (self.backend and self.running):
+            return None
+        self._set_status("終了待ち...")
+        fut = self.finished()
+        def done(f):
+            if f.cancelled() and self.running:
+                self._set_status("終了待ちをやめました")
+        fut.add_done_callback(done)
+        if timeout is not None:
+            self.root.after(int(timeout * 1000), fut.cancel)
+        return fut
+
+    # ---------- Finish notification ----------
+    def finished(self):
+        """
+        今の曲が終わる（または停止される）と完了する Future を返す。結果は "ended" か "stopped"。
+        Tk スレッドでは result() で待たずに add_done_callback を使う。別スレッド（スクリプト等）からは
+        result(timeout=...) で待てる。cancel() するとその待ちだけをやめる（再生は止めない）。
+        """
+        fut = Future()
+        with self._finish_lock:
+            if self.running:
+                self._finish_waiters.append(fut)
+                return fut
+        fut.set_result("stopped")
+        return fut
+
+    def _resolve_finish(self, result):
+        with self._finish_lock:
+            waiters, self._finish_waiters = self._finish_waiters, []
+        for fut in waiters:
+            if fut.set_running_or_notify_cancel():  # cancel 済みは飛ばす
+                fut.set_result(result)
 
     def stop(self):
-        if self.proc:
+        self._pending_start = None
+        if self.backend:
             try:
-                if self.paused:
-                    try:
-                        if os.name == "nt":
-                            ps = psutil.Process(self.proc.pid); ps.resume()
-                        else:
-                            os.kill(self.proc.pid, signal.SIGCONT)
-                    except Exception:
-                        pass
-                if os.name == "nt":
-                    self.proc.terminate()
-                    for _ in range(20):
-                        if self.proc.poll() is not None:
-                            break
-                        time.sleep(0.05)
-                    if self.proc.poll() is None:
-                        self.proc.kill()
-                else:
-                    self.proc.terminate()
+                self.backend.stop()
             except Exception:
                 pass
-            finally:
-                self.proc = None
         self.running = False
         self.paused = False
+        self.clock.stop()
         self._apply_state("stopped")
         self._set_status("停止/終了")
+        self._cleanup_seek_tmp()
+        self._resolve_finish("stopped")
+
+    # ---------- Playback clock ----------
+    def _sync_clock(self):
+        """シンセ側の位置が取れるエンジンでは、時計をそちらに合わせる（長い曲でもずれを溜めない）。"""
+        tick = getattr(self.backend, "current_tick", lambda: None)()
+        idx = self.seek_index
+        if tick is None or tick < 0 or idx is None or idx.path != self.selected_midi_path:
+            return
+        self.clock.sync(idx.tempo_map.tick_to_seconds(self._base_tick + tick))
+
+    def _song_seconds(self):
+        idx = self.seek_index
+        if idx is None or idx.path != self.selected_midi_path or not len(idx.events):
+            return None
+        return idx.tempo_map.tick_to_seconds(int(idx.events["tick"][-1]))
+
+    def _tick_clock(self):
+        """経過時間の表示を更新する。"""
+        if self.running and not self.paused:
+            try:
+                self._sync_clock()
+            except Exception:
+                pass
+        total = self._song_seconds()
+        text = f"⏱ {format_time(self.clock.position())}"
+        if total is not None:
+            text += f" / {format_time(total)}"
+        self.elapsed.config(text=text)
+        self.root.after(200, self._tick_clock)
 
     # ---------- Pickers ----------
     def pick_fluidsynth(self):
@@ -471,7 +804,7 @@ class SimpleMIDIPlayer200Design:
         self.last_fs_dir = os.path.dirname(p)
         self.cfg["fluidsynth"] = p
         self.cfg["last_fs_dir"] = self.last_fs_dir
-        save_config(self.cfg)
+        self._schedule_save()
         self.fs_label.config(text=self._short(self.fs_exe_path))
 
     def pick_sf2(self):
@@ -486,9 +819,137 @@ class SimpleMIDIPlayer200Design:
         self.last_sf2_dir = os.path.dirname(p)
         self.cfg["soundfont"] = p
         self.cfg["last_sf2_dir"] = self.last_sf2_dir
-        save_config(self.cfg)
+        self._schedule_save()
         self.sf_label.config(text=self._short(self.sf2_path))
 
+    # ---------- Playlist ----------
+    def add_to_playlist(self):
+        paths = filedialog.askopenfilenames(
+            title="プレイリストに追加",
+            filetypes=[("MIDI", "*.mid *.midi")],
+            initialdir=self.last_midi_dir
+        )
+        if not paths:
+            return
+        self.last_midi_dir = os.path.dirname(paths[0])
+        self.cfg["last_midi_dir"] = self.last_midi_dir
+        self.playlist.extend(paths)
+        self._save_playlist()
+        if self.running:
+            self._preload_next()
+
+    def remove_from_playlist(self):
+        for i in sorted(self.playlist_box.curselection(), reverse=True):
+            del self.playlist[i]
+            if i < self.playlist_pos:
+                self.playlist_pos -= 1
+            elif i == self.playlist_pos:
+                self.playlist_pos = -1
+        self._save_playlist()
+        if self.running:
+            self._preload_next()
+
+    def _save_playlist(self):
+        self.cfg["playlist"] = list(self.playlist)
+        self._schedule_save()
+        self._refresh_playlist()
+
+    def _refresh_playlist(self):
+        self.playlist_box.delete(0, "end")
+        for i, p in enumerate(self.playlist):
+            self.playlist_box.insert("end", ("▶ " if i == self.playlist_pos else "   ") + os.path.basename(p))
+
+    def _on_continuous_change(self):
+        self.cfg["continuous"] = bool(self.continuous.get())
+        self._schedule_save()
+        if self.running:
+            self._preload_next()
+
+    def _play_selected(self):
+        sel = self.playlist_box.curselection()
+        if sel:
+            self._play_index(sel[0])
+
+    def _play_index(self, i):
+        path = self.playlist[i]
+        self.playlist_pos = i
+        self.selected_midi_path = path
+        self.midi_label.config(text=self._short(path))
+        self.start()
+
+    def _next_in_playlist(self):
+        i = self.playlist_pos + 1
+        if self.continuous.get() and self.playlist_pos >= 0 and i < len(self.playlist):
+            return i
+        return None
+
+    def _preload_next(self):
+        """次の曲の解析と SeekIndex を裏で作っておく。server エンジンにはそのまま次の曲として渡す。"""
+        queue = getattr(self.backend, "queue", None)
+        if queue is not None:
+            queue(None, None)
+        i = self._next_in_playlist()
+        if i is None:
+            return
+        path = self.playlist[i]
+        if self._preloaded is not None and self._preloaded[0] == path:
+            self._queue_preloaded()
+            return
+        self.preload_worker.submit(path, self._on_preloaded, lambda _e: None,
+                                   job=partial(preload_track, cache=self.analysis_cache))
+
+    def _on_preloaded(self, res):
+        self._preloaded = res
+        self._queue_preloaded()
+
+    def _queue_preloaded(self):
+        path, _a, idx = self._preloaded
+        i = self._next_in_playlist()
+        queue = getattr(self.backend, "queue", None)
+        if self.running and queue is not None and idx is not None and i is not None and self.playlist[i] == path:
+            queue(path, idx)
+
+    def _adopt_preloaded(self, midi):
+        """先読み済みの曲なら、その解析結果と SeekIndex をそのまま使う。"""
+        if self._preloaded is None or self._preloaded[0] != midi:
+            return
+        _p, a, idx = self._preloaded
+        if a is not None:
+            self.analysis = a
+        if idx is not None:
+            self.seek_index = idx
+
+    def _on_song_ended(self, _event=None):
+        was_running = self.running
+        self._finalize_ended_process()
+        if was_running and not self.running:
+            i = self._next_in_playlist()
+            if i is not None:
+                self._play_index(i)  # server 以外のエンジン：終わったら次を起動
+
+    def _on_track_changed(self, _event=None):
+        """server エンジンが先読みした次の曲へ切れ目なく移った。表示だけ追いかける。"""
+        try:
+            midi = self._track_changes.get_nowait()
+        except Empty:
+            return
+        # シーケンサーが曲を取った後にリストが変わっていても、実際に鳴っている曲を指す
+        i = self.playlist_pos + 1
+        if not (0 <= i < len(self.playlist) and self.playlist[i] == midi):
+            i = self.playlist.index(midi) if midi in self.playlist else -1
+        self.playlist_pos = i
+        self.selected_midi_path = midi
+        self._instruments_at = 0.0
+        self.midi_label.config(text=self._short(midi))
+        self._refresh_playlist()
+        self._adopt_preloaded(midi)
+        self._base_tick = 0
+        self._set_status(f"再生中: {os.path.basename(midi)}  | drv={self.audio_driver.get()}  gain={self.gain.get():.2f}")
+        if _HAVE_ANALYZER:
+            self._request_analysis(midi)
+        self._prepare_seek_index(midi)
+        self._preload_next()
+
     def pick_midi(self):
         p = filedialog.askopenfilename(
             title="MIDI ファイル",
@@ -499,18 +960,10 @@ class SimpleMIDIPlayer200Design:
             self.selected_midi_path = p
             self.last_midi_dir = os.path.dirname(p)
             self.cfg["last_midi_dir"] = self.last_midi_dir
-            save_config(self.cfg)
+            self._schedule_save()
             self.midi_label.config(text=self._short(p))
-            # 選択直後にメタだけ先に出す（midoがあれば）
-            if _HAVE_MIDO:
-                try:
-                    meta = extract_meta(p)
-                    self.song_meta.config(
-                        text=f"Tempo: {meta['bpm']} BPM  |  TS: {meta['time_sig']}  |  Key: {meta['key']}"
-                             + (f"  (+{meta['tempo_changes']} tempo changes)" if meta['tempo_changes'] else "")
-                    )
-                except Exception:
-                    pass
+            # 選択直後にメタだけ先に出す
+            self._request_meta(p)
 
     # ---------- State / persist ----------
     def _apply_state(self, mode):
@@ -535,7 +988,20 @@ class SimpleMIDIPlayer200Design:
 
     def _persist_controls(self):
         self.cfg["audio_driver"] = self.audio_driver.get()
+        self.cfg["engine"] = self.engine.get()
         self.cfg["gain"] = round(float(self.gain.get()), 2)
+        self._schedule_save()
+
+    def _schedule_save(self):
+        # 連続した変更（スライダーのドラッグなど）は最後の1回だけ書く
+        if self._save_job is not None:
+            self.root.after_cancel(self._save_job)
+        self._save_job = self.root.after(CONFIG_SAVE_DELAY_MS, self._flush_config)
+
+    def _flush_config(self):
+        if self._save_job is not None:
+            self.root.after_cancel(self._save_job)
+            self._save_job = None
         save_config(self.cfg)
 
     def _on_gain_change(self, *_):
@@ -546,6 +1012,48 @@ class SimpleMIDIPlayer200Design:
         self.gain.set(val)
         self.gain_value.config(text=f"{val:.2f}")
         self._persist_controls()
+        if self.running and self.backend is not None:
+            self.backend.set_gain(val)  # 再生中のシンセへ（ランプで寄せる。送れなくても立て直し時に送り直す）
+
+    def _on_driver_change(self):
+        """再生中ならオーディオ出力だけ差し替える。再生位置はそのまま。"""
+        self._persist_controls()
+        backend = self.backend
+        driver = self.audio_driver.get().strip() or DRV_DEFAULT()
+        if not self.running or backend is None or backend.key is None or backend.key[3] == driver:
+            return
+        old = backend.key[3]
+        try:
+            backend.set_driver(driver)
+        except Exception as e:
+            messagebox.showerror("ドライバ切替エラー", f"{driver} に切り替えられません。\n\n{e}")
+            self.audio_driver.set(old)
+            self._persist_controls()
+            if backend.kind == "inprocess":  # 古いドライバはもう消してある。process / server は古い方が鳴り続けている
+                try:
+                    backend.set_driver(old)
+                except Exception:
+                    self.stop()
+            return
+        backend.key = backend.key[:3] + (driver,)
+        name = os.path.basename(self.selected_midi_path or "")
+        self._set_status(f"再生中: {name}  | drv={driver}  gain={self.gain.get():.2f}")
+
+    def _on_driver_failed(self, _event=None):
+        """ドライバ切り替えが裏で失敗した：表示と設定を鳴り続けている方のドライバに戻す。"""
+        try:
+            active, driver, reason = self._driver_failures.get_nowait()
+        except Empty:
+            return
+        backend = self.backend
+        if backend is not None and backend.key is not None:
+            backend.key = backend.key[:3] + (active,)
+        self.audio_driver.set(active)
+        self._persist_controls()
+        if self.running:
+            name = os.path.basename(self.selected_midi_path or "")
+            self._set_status(f"再生中: {name}  | drv={active}  gain={self.gain.get():.2f}")
+        messagebox.showerror("ドライバ切替エラー", f"{driver} に切り替えられません。{active} のまま再生を続けます。\n\n{reason}")
 
     def _toggle_pause_key(self, event):
         if self.running and not self.paused:
@@ -559,17 +1067,24 @@ class SimpleMIDIPlayer200Design:
     # ---------- Cleanup ----------
     def clear_memory(self):
         self.cfg = {}
-        try:
-            with open(config_path(), "w", encoding="utf-8") as f:
-                f.write("{}")
-        except Exception:
-            pass
+        self._flush_config()
         self.sf2_path = None
         self.fs_exe_path = None
         self.audio_driver.set(DRV_DEFAULT())
+        self.engine.set("process")
         self.gain.set(0.8)
         self.dark.set(False)
         self.selected_midi_path = None
+        self.analysis = None
+        self.analysis_worker.cancel()
+        self.seek_index = None
+        self.seek_worker.cancel()
+        self.playlist = []
+        self.playlist_pos = -1
+        self.continuous.set(True)
+        self._preloaded = None
+        self.preload_worker.cancel()
+        self._refresh_playlist()
         self.fs_label.config(text="PATH を使用")
         self.sf_label.config(text="未選択")
         self.midi_label.config(text="未選択")
@@ -579,70 +1094,510 @@ class SimpleMIDIPlayer200Design:
 
     def on_close(self):
         self.stop()
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+        self.analysis_worker.shutdown()
+        self.seek_worker.shutdown()
+        self.preload_worker.shutdown()
+        self._cleanup_seek_tmp()
+        self._flush_config()
         self.root.destroy()
 
 def DRV_DEFAULT():
     return "dsound"  # Windows既定
 
-# ---------- Instrument extraction helper (using mido) ----------
-def extract_instruments(midi_path):
+# ---------- Single-pass MIDI analysis (numpy / mido) ----------
+# 1回のデコードで楽器・バンク・テンポ/拍子/キー・ノート統計をまとめて取る
+MidiAnalysis = namedtuple("MidiAnalysis", [
+    "path",               # 解析したファイル
+    "ticks_per_beat",     # 分解能 (PPQN)
+    "length_ticks",       # 最長トラックの長さ (ticks)
+    "instruments",        # ((ch 1-16, bank, program, name), ...)
+    "banks",              # ((ch 1-16, bank_msb, bank_lsb), ...)
+    "tempos",             # ((abs_ticks, tempo_us_per_quarter), ...)
+    "time_sigs",          # ((abs_ticks, nn, dd), ...)
+    "keys",               # ((abs_ticks, key_text), ...)
+    "note_count",         # note_on (velocity > 0) の総数
+    "note_min",           # 最低音 (なければ None)
+    "note_max",           # 最高音 (なければ None)
+    "channel_notes",      # チャンネルごとの note_on 数 (16要素)
+])
+
+def analyze_midi(midi_path):
     """
-    Returns dict: {channel(int 1-16): (bank(int), program(int 0-127), name(str))}
-    - Channel 10 -> Drums (bank=128, program=0, name='Drums (Standard Kit)')
-    - For channels without explicit program_change, assume program 0 (Acoustic Grand Piano)
-    - Bank select via CC#0 (MSB) and CC#32 (LSB) when present
+    Decode midi_path once and return an immutable MidiAnalysis.
+    numpy があれば生の SMF を列指向テーブルに読んでベクトル演算で集計し、
+    なければ mido で1パス走査する。
+    """
+    if _HAVE_NUMPY:
+        return analyze_event_table(read_midi_events(midi_path))
+    return _analyze_midi_mido(midi_path)
+
+def _analyze_midi_mido(midi_path):
+    """
+    mido fallback for analyze_midi.
+    - Instruments follow extract_instruments rules (first program_change wins,
+      last bank select in track order, Ch10 -> Drums)
+    - Tempo / time signature / key maps are sorted by absolute tick
     """
     mid = mido.MidiFile(midi_path)
     chan_info = {ch: {"bank_msb": 0, "bank_lsb": 0, "program": None} for ch in range(16)}
+    tempos = []      # (abs_ticks, tempo_us_per_quarter)
+    time_sigs = []   # (abs_ticks, nn, dd)
+    keys = []        # (abs_ticks, key_text)
+    channel_notes = [0] * 16
+    note_min = None
+    note_max = None
+    length_ticks = 0
 
     for track in mid.tracks:
+        abs_ticks = 0
         for msg in track:
-            if msg.type == "control_change":
+            abs_ticks += msg.time
+            t = msg.type
+            if t == "note_on":
+                if msg.velocity > 0:
+                    channel_notes[msg.channel] += 1
+                    n = msg.note
+                    if note_min is None or n < note_min:
+                        note_min = n
+                    if note_max is None or n > note_max:
+                        note_max = n
+            elif t == "control_change":
                 ch = msg.channel
                 if msg.control == 0:   # Bank Select MSB
                     chan_info[ch]["bank_msb"] = msg.value
                 elif msg.control == 32:  # Bank Select LSB
                     chan_info[ch]["bank_lsb"] = msg.value
-            elif msg.type == "program_change":
+            elif t == "program_change":
                 ch = msg.channel
                 if chan_info[ch]["program"] is None:
                     chan_info[ch]["program"] = msg.program
+            elif t == "set_tempo":
+                tempos.append((abs_ticks, msg.tempo))
+            elif t == "time_signature":
+                time_sigs.append((abs_ticks, msg.numerator, msg.denominator))
+            elif t == "key_signature":
+                keys.append((abs_ticks, msg.key))
+        length_ticks = max(length_ticks, abs_ticks)
 
-    used = {}
+    instruments = []
     for ch in range(16):
         disp_ch = ch + 1  # human-friendly
         if disp_ch == 10:
-            used[disp_ch] = (128, 0, "Drums (Standard Kit)")
+            instruments.append((disp_ch, 128, 0, "Drums (Standard Kit)"))
             continue
         pg = chan_info[ch]["program"]
         bank = chan_info[ch]["bank_msb"] * 128 + chan_info[ch]["bank_lsb"]
         if pg is None:
             pg = 0  # default piano when no program change
         name = GM_PROGRAMS[pg] if 0 <= pg < 128 else f"Program {pg}"
-        used[disp_ch] = (bank, pg, name)
-    return used
+        instruments.append((disp_ch, bank, pg, name))
+
+    # トラック順に集めたので時刻順に並べ直す（同時刻はトラック順を維持）
+    tempos.sort(key=lambda e: e[0])
+    time_sigs.sort(key=lambda e: e[0])
+    keys.sort(key=lambda e: e[0])
+
+    return MidiAnalysis(
+        path=midi_path,
+        ticks_per_beat=mid.ticks_per_beat,
+        length_ticks=length_ticks,
+        instruments=tuple(instruments),
+        banks=tuple((ch + 1, chan_info[ch]["bank_msb"], chan_info[ch]["bank_lsb"]) for ch in range(16)),
+        tempos=tuple(tempos),
+        time_sigs=tuple(time_sigs),
+        keys=tuple(keys),
+        note_count=sum(channel_notes),
+        note_min=note_min,
+        note_max=note_max,
+        channel_notes=tuple(channel_notes),
+    )
+
+# ---------- Raw SMF reader → columnar event table (numpy) ----------
+# チャンネルメッセージ1件 = 10 bytes。mido の Message オブジェクトより桁違いに小さい
+EVENT_DTYPE = [
+    ("tick", "<u4"),     # 絶対 tick
+    ("status", "u1"),    # 0x80, 0x90, ... 0xE0（上位4bit）
+    ("channel", "u1"),   # 0-15
+    ("data1", "u1"),
+    ("data2", "u1"),
+    ("track", "<u2"),    # 何番目の MTrk か
+]
+
+# key_signature の sf (-7..7) → mido と同じ表記
+_MAJOR_KEYS = ["Cb", "Gb", "Db", "Ab", "Eb", "Bb", "F", "C", "G", "D", "A", "E", "B", "F#", "C#"]
+_MINOR_KEYS = ["Abm", "Ebm", "Bbm", "Fm", "Cm", "Gm", "Dm", "Am", "Em", "Bm", "F#m", "C#m", "G#m", "D#m", "A#m"]
 
-# ---------- Tempo/Key extraction helper (using mido) ----------
-def extract_meta(midi_path):
+class MidiEventTable:
+    """
+    1ファイル分のチャンネルイベントを構造化配列 events (EVENT_DTYPE) で持つ。
+    events はトラック順 → トラック内の時刻順に並ぶ。
+    メタイベントは数が少ないので metas = [(tick, track, type, payload bytes), ...] で別持ち。
     """
+    def __init__(self, path, fmt, ticks_per_beat, events, metas, track_lengths):
+        self.path = path
+        self.fmt = fmt
+        self.ticks_per_beat = ticks_per_beat
+        self.events = events
+        self.metas = metas
+        self.track_lengths = track_lengths
+
+    def select(self, status, control=None):
+        """status (0x80..0xE0) のイベントだけを返す。control を渡すと CC 番号でも絞る。"""
+        ev = self.events
+        mask = ev["status"] == status
+        if control is not None:
+            mask &= ev["data1"] == control
+        return ev[mask]
+
+    def note_ons(self):
+        """velocity > 0 の note_on。"""
+        ev = self.events
+        return ev[(ev["status"] == 0x90) & (ev["data2"] > 0)]
+
+    def meta(self, mtype):
+        """指定タイプのメタイベントを時刻順に [(tick, payload), ...] で返す。"""
+        found = [(tick, payload) for tick, _trk, t, payload in self.metas if t == mtype]
+        found.sort(key=lambda e: e[0])
+        return found
+
+def _read_vlq(buf, i):
+    b = buf[i]
+    i += 1
+    value = b & 0x7F
+    while b & 0x80:
+        b = buf[i]
+        i += 1
+        value = (value << 7) | (b & 0x7F)
+    return value, i
+
+def _iter_smf_chunks(buf):
+    """(chunk_id, payload_offset, payload_length) を順に返す。壊れた末尾は黙って打ち切る。"""
+    pos = 0
+    n = len(buf)
+    while pos + 8 <= n:
+        cid = bytes(buf[pos:pos + 4])
+        (length,) = struct.unpack(">I", buf[pos + 4:pos + 8])
+        pos += 8
+        yield cid, pos, min(length, n - pos)
+        pos += length
+
+class SmfFile:
+    """
+    .mid を mmap し、MTrk チャンクの位置だけ先に調べておく読み取り専用リーダー。
+    トラックは問い合わせで必要になったものだけ memoryview 上で直接デコードする。
+        with SmfFile(path) as smf:
+            metas = smf.meta_events()
+    """
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._f.close()
+            raise ValueError("Standard MIDI File ではありません（空のファイル）")
+        self.buf = memoryview(self._mm)
+        try:
+            chunks = _iter_smf_chunks(self.buf)
+            cid, pos, length = next(chunks, (None, 0, 0))
+            if cid != b"MThd" or length < 6:
+                raise ValueError("Standard MIDI File ではありません（MThd がありません）")
+            self.fmt, _ntrks, self.ticks_per_beat = struct.unpack(">HHh", self.buf[pos:pos + 6])
+            # 未知のチャンクは仕様どおり読み飛ばす
+            self.tracks = [(pos, length) for cid, pos, length in chunks if cid == b"MTrk"]
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.release()
+            self.buf = None
+            self._mm.close()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _track_ids(self, tracks):
+        return range(len(self.tracks)) if tracks is None else tracks
+
+    def meta_events(self, tracks=None, until_tick=None):
+        """
+        メタイベントだけを [(tick, track, type, payload), ...] で返す。チャンネルメッセージは読み飛ばす。
+        until_tick を渡すと、その tick を過ぎたところで各トラックのデコードを打ち切る。
+        """
+        metas = []
+        for t in self._track_ids(tracks):
+            pos, length = self.tracks[t]
+            _scan_track_meta(self.buf, pos, pos + length, metas, t, until_tick)
+        return metas
+
+    def event_table(self, tracks=None):
+        """指定トラック（省略時は全部）だけをデコードして MidiEventTable を返す。"""
+        cols = (array.array("I"), array.array("B"), array.array("I"))
+        metas = []
+        track_lengths = []
+        track_ids = []
+        track_counts = []
+        for t in self._track_ids(tracks):
+            pos, length = self.tracks[t]
+            before = len(cols[0])
+            track_lengths.append(_decode_track(self.buf, pos, pos + length, cols, metas, t))
+            track_ids.append(t)
+            track_counts.append(len(cols[0]) - before)
+        events = _build_event_array(self.buf, cols, track_ids, track_counts)
+        return MidiEventTable(self.path, self.fmt, self.ticks_per_beat, events, metas, tuple(track_lengths))
+
+def _scan_track_meta(buf, start, end, metas, track_no, until_tick=None):
+    """_decode_track のメタ専用版。チャンネルメッセージはデータ長だけ進める。"""
+    tick = 0
+    running = 0
+    i = start
+    try:
+        while i < end:
+            b = buf[i]
+            i += 1
+            if b & 0x80:
+                delta = b & 0x7F
+                while b & 0x80:
+                    b = buf[i]
+                    i += 1
+                    delta = (delta << 7) | (b & 0x7F)
+                tick += delta
+            else:
+                tick += b
+            if until_tick is not None and tick > until_tick:
+                break
+            st = buf[i]
+            if st & 0x80:
+                i += 1
+                if st < 0xF0:
+                    running = st
+            elif running:
+                st = running
+            else:
+                break
+            if st < 0xF0:
+                hi = st & 0xF0
+                i += 1 if hi == 0xC0 or hi == 0xD0 else 2
+            elif st == 0xFF:
+                mtype = buf[i]
+                length, i = _read_vlq(buf, i + 1)
+                if mtype == 0x2F:  # End of Track
+                    break
+                metas.append((tick, track_no, mtype, bytes(buf[i:i + length])))
+                i += length
+            elif st == 0xF0 or st == 0xF7:
+                length, i = _read_vlq(buf, i)
+                i += length
+                running = 0
+            else:
+                break
+    except IndexError:
+        pass
+    return tick
+
+def _decode_track(buf, start, end, cols, metas, track_no):
+    """
+    buf[start:end] の MTrk 1本をデコードする。
+    チャンネルメッセージは (tick, status, data1 のオフセット) だけを cols に積み、
+    data1/data2 は後で numpy がまとめて buf から拾う。
+    Returns the track length in ticks.
+    """
+    ticks, statuses, offsets = cols
+    t_append = ticks.append
+    s_append = statuses.append
+    o_append = offsets.append
+    tick = 0
+    running = 0
+    i = start
+    try:
+        while i < end:
+            b = buf[i]
+            i += 1
+            if b & 0x80:
+                delta = b & 0x7F
+                while b & 0x80:
+                    b = buf[i]
+                    i += 1
+                    delta = (delta << 7) | (b & 0x7F)
+                tick += delta
+            else:
+                tick += b
+            st = buf[i]
+            if st & 0x80:
+                i += 1
+                if st < 0xF0:
+                    running = st
+            elif running:
+                st = running  # running status
+            else:
+                break
+            if st < 0xF0:
+                t_append(tick)
+                s_append(st)
+                o_append(i)
+                hi = st & 0xF0
+                i += 1 if hi == 0xC0 or hi == 0xD0 else 2
+            elif st == 0xFF:
+                mtype = buf[i]
+                length, i = _read_vlq(buf, i + 1)
+                if mtype == 0x2F:  # End of Track
+                    break
+                metas.append((tick, track_no, mtype, bytes(buf[i:i + length])))
+                i += length
+            elif st == 0xF0 or st == 0xF7:
+                length, i = _read_vlq(buf, i)
+                i += length
+                running = 0
+            else:
+                break
+    except IndexError:
+        pass  # 途中で切れたトラックはそこまで
+    # 末尾で切れたメッセージは捨てる
+    while offsets and offsets[-1] + (1 if (statuses[-1] & 0xF0) in (0xC0, 0xD0) else 2) > end:
+        ticks.pop()
+        statuses.pop()
+        offsets.pop()
+    return tick
+
+def read_midi_events(midi_path):
+    """Read a Standard MIDI File straight into a MidiEventTable (no mido)."""
+    with SmfFile(midi_path) as smf:
+        return smf.event_table()
+
+MidiMeta = namedtuple("MidiMeta", ["path", "ticks_per_beat", "tempos", "time_sigs", "keys"])
+
+def read_midi_meta(midi_path, mode="full"):
+    """
+    Tempo / time signature / key maps only, via the mmap reader.
+    チャンネルメッセージは保持しないので numpy も mido も不要。
+    - mode="full":    全トラックを最後まで走査して完全なマップを返す
+    - mode="initial": 先頭 (tick 0) の値だけ。コンダクタートラック (track 0) だけを読み、
+                      tick 0 を過ぎたら打ち切るので曲の長さに関係なく一定時間で終わる
+    """
+    with SmfFile(midi_path) as smf:
+        if mode == "initial":
+            metas = smf.meta_events(tracks=[0] if smf.tracks else [], until_tick=0)
+        else:
+            metas = smf.meta_events()
+        tempos, time_sigs, keys = _decode_meta_maps(metas)
+        return MidiMeta(midi_path, smf.ticks_per_beat, tempos, time_sigs, keys)
+
+def _decode_meta_maps(metas):
+    """metas から (tempos, time_sigs, keys) を時刻順のタプルで作る。"""
+    tempos = []
+    time_sigs = []
+    keys = []
+    for tick, _trk, mtype, p in sorted(metas, key=lambda e: e[0]):
+        if mtype == 0x51 and len(p) >= 3:
+            tempos.append((tick, (p[0] << 16) | (p[1] << 8) | p[2]))
+        elif mtype == 0x58 and len(p) >= 2:
+            time_sigs.append((tick, p[0], 2 ** p[1]))
+        elif mtype == 0x59 and len(p) >= 2:
+            sf = struct.unpack("b", p[:1])[0]
+            if -7 <= sf <= 7:
+                keys.append((tick, (_MINOR_KEYS if p[1] else _MAJOR_KEYS)[sf + 7]))
+    return tuple(tempos), tuple(time_sigs), tuple(keys)
+
+def _build_event_array(data, cols, track_ids, track_counts):
+    """(tick, status, offset) の列から EVENT_DTYPE の構造化配列をベクトル演算で組み立てる。"""
+    ticks, statuses, offsets = cols
+    n = len(ticks)
+    events = np.zeros(n, dtype=EVENT_DTYPE)
+    if not n:
+        return events
+    raw = np.frombuffer(data, dtype=np.uint8)
+    st = np.frombuffer(statuses, dtype=np.uint8)
+    off = np.frombuffer(offsets, dtype=np.uint32).astype(np.intp)
+    hi = st & 0xF0
+    two = (hi != 0xC0) & (hi != 0xD0)
+    events["tick"] = np.frombuffer(ticks, dtype=np.uint32)
+    events["status"] = hi
+    events["channel"] = st & 0x0F
+    events["data1"] = raw[off] & 0x7F
+    events["data2"] = np.where(two, raw[np.minimum(off + 1, len(raw) - 1)], 0) & 0x7F
+    events["track"] = np.repeat(np.asarray(track_ids, dtype=np.uint16), track_counts)
+    return events
+
+def _first_per_channel(ev, field, last=False):
+    """ch(0-15) -> 最初（last=True なら最後）のイベントの field 値。events の並び順で判定。"""
+    if len(ev) == 0:
+        return {}
+    if last:
+        ev = ev[::-1]
+    uniq, idx = np.unique(ev["channel"], return_index=True)
+    return {int(c): int(v) for c, v in zip(uniq, ev[field][idx])}
+
+def analyze_event_table(table):
+    """Vectorized MidiAnalysis over a MidiEventTable (same rules as the mido path)."""
+    programs = _first_per_channel(table.select(0xC0), "data1")
+    # バンクはトラック順で最後に現れた値
+    bank_msb = _first_per_channel(table.select(0xB0, control=0), "data2", last=True)
+    bank_lsb = _first_per_channel(table.select(0xB0, control=32), "data2", last=True)
+
+    instruments = []
+    for ch in range(16):
+        disp_ch = ch + 1  # human-friendly
+        if disp_ch == 10:
+            instruments.append((disp_ch, 128, 0, "Drums (Standard Kit)"))
+            continue
+        pg = programs.get(ch, 0)  # default piano when no program change
+        bank = bank_msb.get(ch, 0) * 128 + bank_lsb.get(ch, 0)
+        name = GM_PROGRAMS[pg] if 0 <= pg < 128 else f"Program {pg}"
+        instruments.append((disp_ch, bank, pg, name))
+
+    notes = table.note_ons()
+    channel_notes = np.bincount(notes["channel"], minlength=16)[:16] if len(notes) else [0] * 16
+
+    tempos, time_sigs, keys = _decode_meta_maps(table.metas)
+
+    return MidiAnalysis(
+        path=table.path,
+        ticks_per_beat=table.ticks_per_beat,
+        length_ticks=max(table.track_lengths, default=0),
+        instruments=tuple(instruments),
+        banks=tuple((ch + 1, bank_msb.get(ch, 0), bank_lsb.get(ch, 0)) for ch in range(16)),
+        tempos=tempos,
+        time_sigs=time_sigs,
+        keys=keys,
+        note_count=int(len(notes)),
+        note_min=int(notes["data1"].min()) if len(notes) else None,
+        note_max=int(notes["data1"].max()) if len(notes) else None,
+        channel_notes=tuple(int(c) for c in channel_notes),
+    )
+
+def _as_analysis(src):
+    return src if isinstance(src, MidiAnalysis) else analyze_midi(src)
+
+# ---------- Instrument extraction helper ----------
+def extract_instruments(src):
+    """
+    src: MIDI path or MidiAnalysis.
+    Returns dict: {channel(int 1-16): (bank(int), program(int 0-127), name(str))}
+    - Channel 10 -> Drums (bank=128, program=0, name='Drums (Standard Kit)')
+    - For channels without explicit program_change, assume program 0 (Acoustic Grand Piano)
+    - Bank select via CC#0 (MSB) and CC#32 (LSB) when present
+    """
+    a = _as_analysis(src)
+    return {ch: (bank, prog, name) for ch, bank, prog, name in a.instruments}
+
+# ---------- Tempo/Key extraction helper ----------
+def extract_meta(src):
+    """
+    src: MIDI path, MidiAnalysis or MidiMeta.
     Returns dict with: bpm (float), time_sig "N/D", key (str),
     and counts of changes (tempo_changes, key_changes, ts_changes).
     """
-    mid = mido.MidiFile(midi_path)
-    tempos = []      # (abs_ticks, tempo_us_per_quarter)
-    time_sigs = []   # (abs_ticks, (nn, dd))
-    keys = []        # (abs_ticks, key_text)
-
-    for track in mid.tracks:
-        abs_ticks = 0
-        for msg in track:
-            abs_ticks += msg.time
-            if msg.type == "set_tempo":
-                tempos.append((abs_ticks, msg.tempo))
-            elif msg.type == "time_signature":
-                time_sigs.append((abs_ticks, (msg.numerator, msg.denominator)))
-            elif msg.type == "key_signature":
-                keys.append((abs_ticks, msg.key))
+    a = src if isinstance(src, (MidiAnalysis, MidiMeta)) else read_midi_meta(src)
+    tempos, time_sigs, keys = a.tempos, a.time_sigs, a.keys
 
     # 初期値
     bpm_init = 120.0
@@ -654,7 +1609,7 @@ def extract_meta(midi_path):
 
     ts_init = (4, 4)
     if time_sigs:
-        ts_init = time_sigs[0][1]
+        ts_init = time_sigs[0][1:]
 
     key_init = "不明"
     if keys:
@@ -686,10 +1641,1662 @@ def normalize_key_text(k: str) -> str:
         return k2
     return k2 + " major"
 
+# ---------- On-disk analysis cache (SQLite) ----------
+class AnalysisCache:
+    """
+    mhp_config.json と同じ場所に置く MidiAnalysis のキャッシュ。
+    - Key: 絶対パス + サイズ + mtime（use_hash=True ならファイル内容の BLAKE2b も照合）
+    - Value: zlib 圧縮した JSON
+    - LRU: last_used の古い順に max_entries / max_bytes を超えた分を削除
+    接続はスレッドをまたがないよう操作ごとに開く。失敗しても例外は外に出さない。
+    """
+    VERSION = 1
+
+    def __init__(self, path=None, max_entries=10000, max_bytes=64 * 1024 * 1024, use_hash=False):
+        self.path = path or os.path.join(os.path.dirname(config_path()), ANALYSIS_CACHE_NAME)
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.use_hash = bool(use_hash)
+        self._ready = False
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=5)
+        if not self._ready:
+            ver = con.execute("PRAGMA user_version").fetchone()[0]
+            if ver != self.VERSION:
+                con.execute("DROP TABLE IF EXISTS analysis")
+                con.execute(f"PRAGMA user_version = {self.VERSION}")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS analysis ("
+                " path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,"
+                " digest TEXT, last_used REAL, data BLOB)"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS analysis_digest ON analysis(size, digest)")
+            con.commit()
+            self._ready = True
+        return con
+
+    @staticmethod
+    def _digest(midi_path):
+        h = hashlib.blake2b(digest_size=16)
+        with open(midi_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def _encode(a):
+        rec = a._asdict()
+        rec.pop("path")
+        return zlib.compress(json.dumps(rec, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def _decode(midi_path, blob):
+        def tup(v):
+            return tuple(tup(x) for x in v) if isinstance(v, list) else v
+        rec = json.loads(zlib.decompress(blob).decode("utf-8"))
+        return MidiAnalysis(path=midi_path, **{k: tup(v) for k, v in rec.items()})
+
+    def get(self, midi_path):
+        """キャッシュ済みなら MidiAnalysis、なければ None。"""
+        try:
+            key = os.path.abspath(midi_path)
+            st = os.stat(key)
+            con = self._connect()
+            try:
+                row = con.execute(
+                    "SELECT size, mtime_ns, digest, data FROM analysis WHERE path = ?", (key,)
+                ).fetchone()
+                digest = None
+                if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+                    if self.use_hash:
+                        digest = self._digest(key)
+                        if row[2] != digest:
+                            row = None
+                else:
+                    row = None
+                if row is None and self.use_hash:
+                    # 移動/リネームされた同一内容のファイルも拾う
+                    digest = digest or self._digest(key)
+                    row = con.execute(
+                        "SELECT size, mtime_ns, digest, data FROM analysis WHERE size = ? AND digest = ?",
+                        (st.st_size, digest),
+                    ).fetchone()
+                if row is None:
+                    return None
+                con.execute("UPDATE analysis SET last_used = ? WHERE path = ? OR (size = ? AND digest = ?)",
+                            (time.time(), key, st.st_size, row[2]))
+                con.commit()
+                return self._decode(midi_path, row[3])
+            finally:
+                con.close()
+        except Exception:
+            return None
+
+    def put(self, a):
+        try:
+            key = os.path.abspath(a.path)
+            st = os.stat(key)
+            digest = self._digest(key) if self.use_hash else None
+            blob = self._encode(a)
+            con = self._connect()
+            try:
+                con.execute(
+                    "INSERT OR REPLACE INTO analysis (path, size, mtime_ns, digest, last_used, data)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, st.st_size, st.st_mtime_ns, digest, time.time(), sqlite3.Binary(blob)),
+                )
+                self._evict(con)
+                con.commit()
+            finally:
+                con.close()
+        except Exception:
+            pass
+
+    def _evict(self, con):
+        count, total = con.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM analysis").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        for path, size in con.execute("SELECT path, LENGTH(data) FROM analysis ORDER BY last_used ASC").fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            con.execute("DELETE FROM analysis WHERE path = ?", (path,))
+            count -= 1
+            total -= size
+
+    def clear(self):
+        try:
+            con = self._connect()
+            try:
+                con.execute("DELETE FROM analysis")
+                con.commit()
+            finally:
+                con.close()
+        except Exception:
+            pass
+
+# ---------- Background analysis worker ----------
+class AnalysisWorker:
+    """
+    Tk スレッドを止めないための解析用ワーカー（1スレッド）。
+    submit() するたびに世代番号を進め、古い世代のジョブは未着手ならキャンセル、
+    実行済みでも結果は捨てる。結果は root.after で Tk スレッドに戻す。
+    """
+    def __init__(self, root, cache=None):
+        self.root = root
+        self.cache = cache
+        self._gen = 0
+        self._future = None
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mhp-analysis")
+
+    def submit(self, midi_path, on_done, on_error=None, job=None):
+        """job(midi_path) を実行する。省略時はキャッシュ付きの analyze_midi。"""
+        with self._lock:
+            self._gen += 1
+            gen = self._gen
+            if self._future is not None:
+                self._future.cancel()
+            self._future = self._pool.submit(self._run, gen, midi_path, on_done, on_error, job)
+
+    def cancel(self):
+        with self._lock:
+            self._gen += 1
+            if self._future is not None:
+                self._future.cancel()
+                self._future = None
+
+    def shutdown(self):
+        self.cancel()
+        self._pool.shutdown(wait=False)
+
+    def _run(self, gen, midi_path, on_done, on_error, job):
+        if gen != self._gen:
+            return
+        try:
+            a = job(midi_path) if job is not None else analyze_midi_cached(midi_path, self.cache)
+        except Exception as e:
+            if on_error is not None:
+                self._post(gen, on_error, e)
+            return
+        self._post(gen, on_done, a)
+
+    def _post(self, gen, fn, arg):
+        def deliver():
+            if gen == self._gen:
+                fn(arg)
+        try:
+            self.root.after(0, deliver)
+        except Exception:
+            pass  # ウィンドウ破棄後
+
+def analyze_midi_cached(midi_path, cache=None):
+    """cache にあればそれを返し、なければ analyze_midi して保存する。"""
+    if cache is not None:
+        a = cache.get(midi_path)
+        if a is not None:
+            return a
+    a = analyze_midi(midi_path)
+    if cache is not None:
+        cache.put(a)
+    return a
+
+# ---------- Tempo map / seek (numpy) ----------
+class TempoMap:
+    """
+    tick <-> 秒 の変換。tempos は ((abs_tick, us_per_quarter), ...)。
+    SMPTE 分解能（division < 0）の場合はテンポに関係なく一定レート。
+    """
+    def __init__(self, tempos, division):
+        self.division = division
+        self.ticks = [0]
+        self.secs = [0.0]
+        self.tempos = [500000]  # 120 BPM
+        for tick, tempo in tempos:
+            if tick == self.ticks[-1]:
+                self.tempos[-1] = tempo
+                continue
+            self.secs.append(self._seconds_from(len(self.ticks) - 1, tick))
+            self.ticks.append(tick)
+            self.tempos.append(tempo)
+
+    def _seconds_from(self, seg, tick):
+        if self.division < 0:
+            fps = -(self.division >> 8)
+            fps = 29.97 if fps == 29 else fps
+            return tick / (fps * (self.division & 0xFF))
+        return self.secs[seg] + (tick - self.ticks[seg]) * self.tempos[seg] / (1e6 * self.division)
+
+    def tick_to_seconds(self, tick):
+        return self._seconds_from(bisect_right(self.ticks, tick) - 1, tick)
+
+    def seconds_to_tick(self, sec):
+        if sec <= 0:
+            return 0
+        if self.division < 0:
+            return int(sec / self.tick_to_seconds(1))
+        seg = bisect_right(self.secs, sec) - 1
+        return self.ticks[seg] + int((sec - self.secs[seg]) * 1e6 * self.division / self.tempos[seg])
+
+    def ticks_to_seconds(self, ticks):
+        """tick_to_seconds の numpy 配列版。"""
+        ticks = np.asarray(ticks, dtype=np.float64)
+        if self.division < 0:
+            return ticks * self.tick_to_seconds(1)
+        seg = np.searchsorted(np.asarray(self.ticks), ticks, side="right") - 1
+        base_t = np.asarray(self.ticks, dtype=np.float64)[seg]
+        base_s = np.asarray(self.secs)[seg]
+        tempo = np.asarray(self.tempos, dtype=np.float64)[seg]
+        return base_s + (ticks - base_t) * tempo / (1e6 * self.division)
+
+    def tempo_at(self, tick):
+        return self.tempos[bisect_right(self.ticks, tick) - 1]
+
+# 状態として追いかけない CC（データエントリ系とチャンネルモードメッセージ）
+_NO_CHASE_CC = {6, 38, 96, 97, 98, 99, 100, 101} | set(range(120, 128))
+
+# スナップショットの間隔（曲中の秒数 / 状態イベント数のどちらか早い方）
+SNAPSHOT_SECONDS = 5.0
+SNAPSHOT_EVENTS = 20000
+
+def _last_per_key(keys, values):
+    """keys が同じものの中で最後に現れた values を (uniq_keys, values) で返す（並び順基準）。"""
+    uniq, idx = np.unique(keys[::-1], return_index=True)
+    return uniq, values[::-1][idx]
+
+class ChannelState:
+    """
+    16チャンネル分のコントローラ状態（extract_instruments の chan_info を配列にしたもの）。
+    - cc[ch, ctrl]: 最後の CC 値（Bank MSB/LSB・Volume・Pan・Sustain も含む、未設定は -1）
+    - program[ch], bend[ch]（14bit）: 未設定は -1
+    - rpn[(ch, msb, lsb)] = [value_msb, value_lsb]（Pitch Bend Range / Tuning など）
+    """
+    def __init__(self):
+        self.cc = np.full((16, 128), -1, dtype=np.int16)
+        self.program = np.full(16, -1, dtype=np.int16)
+        self.bend = np.full(16, -1, dtype=np.int32)
+        self.nrpn = [False] * 16  # 最後に選ばれたのが NRPN か
+        self.rpn = {}
+
+    def copy(self):
+        st = ChannelState()
+        st.cc[:] = self.cc
+        st.program[:] = self.program
+        st.bend[:] = self.bend
+        st.nrpn = list(self.nrpn)
+        st.rpn = {k: list(v) for k, v in self.rpn.items()}
+        return st
+
+    def apply(self, ev):
+        """時刻順のイベント ev を反映する。CC/Program/Bend はベクトル演算、RPN だけ順に追う。"""
+        if len(ev) == 0:
+            return self
+        cc = ev[ev["status"] == 0xB0]
+        if len(cc):
+            self._apply_rpn(cc)
+            keys, vals = _last_per_key(cc["channel"].astype(np.intp) * 128 + cc["data1"], cc["data2"])
+            self.cc.reshape(-1)[keys] = vals
+        pc = ev[ev["status"] == 0xC0]
+        if len(pc):
+            keys, vals = _last_per_key(pc["channel"].astype(np.intp), pc["data1"])
+            self.program[keys] = vals
+        pb = ev[ev["status"] == 0xE0]
+        if len(pb):
+            keys, vals = _last_per_key(pb["channel"].astype(np.intp),
+                                       pb["data2"].astype(np.int32) * 128 + pb["data1"])
+            self.bend[keys] = vals
+        return self
+
+    def _apply_rpn(self, cc):
+        ctrl = cc["data1"]
+        rows = cc[(ctrl == 6) | (ctrl == 38) | ((ctrl >= 98) & (ctrl <= 101))]
+        cur = self.cc
+        for ch, c, v in zip(rows["channel"].tolist(), rows["data1"].tolist(), rows["data2"].tolist()):
+            if c in (101, 100):
+                self.nrpn[ch] = False
+                cur[ch, c] = v
+            elif c in (99, 98):
+                self.nrpn[ch] = True
+            elif not self.nrpn[ch]:
+                key = (ch, int(cur[ch, 101]), int(cur[ch, 100]))
+                if key[1] < 0 or key[2] < 0 or (key[1] == 127 and key[2] == 127):
+                    continue  # RPN 未選択 / Null
+                val = self.rpn.setdefault(key, [0, 0])
+                val[0 if c == 6 else 1] = v
+
+    def messages(self):
+        """
+        この状態を再現するメッセージ列 [(status, channel, data1, data2), ...]。
+        順序: Bank MSB/LSB → Program → その他の CC → RPN → Pitch Bend
+        """
+        msgs = []
+        for ch in range(16):
+            row = self.cc[ch]
+            for ctrl in (0, 32):
+                if row[ctrl] >= 0:
+                    msgs.append((0xB0, ch, ctrl, int(row[ctrl])))
+            if self.program[ch] >= 0:
+                msgs.append((0xC0, ch, int(self.program[ch]), 0))
+            for ctrl in np.flatnonzero(row >= 0).tolist():
+                if ctrl not in (0, 32) and ctrl not in _NO_CHASE_CC:
+                    msgs.append((0xB0, ch, ctrl, int(row[ctrl])))
+            rpns = sorted(k for k in self.rpn if k[0] == ch)
+            for _ch, msb, lsb in rpns:
+                vm, vl = self.rpn[(ch, msb, lsb)]
+                msgs += [(0xB0, ch, 101, msb), (0xB0, ch, 100, lsb), (0xB0, ch, 6, vm), (0xB0, ch, 38, vl)]
+            if rpns:
+                msgs += [(0xB0, ch, 101, 127), (0xB0, ch, 100, 127)]  # RPN Null
+            if self.bend[ch] >= 0:
+                msgs.append((0xE0, ch, int(self.bend[ch]) & 0x7F, int(self.bend[ch]) >> 7))
+        return msgs
+
+def _vlq(value):
+    out = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        out.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(out)
+
+def _encode_channel_events(ev):
+    """時刻順のチャンネルイベントを MTrk 本体のバイト列にベクトル演算でエンコードする（running status なし）。"""
+    if len(ev) == 0:
+        return b""
+    ticks = ev["tick"].astype(np.int64)
+    delta = np.diff(ticks, prepend=0)
+    nv = 1 + (delta >= 1 << 7) + (delta >= 1 << 14) + (delta >= 1 << 21)
+    hi = ev["status"]
+    nd = np.where((hi == 0xC0) | (hi == 0xD0), 1, 2)
+    size = nv + 1 + nd
+    off = np.concatenate(([0], np.cumsum(size)[:-1]))
+    out = np.zeros(int(size.sum()), dtype=np.uint8)
+    for k in range(4):
+        m = nv > k
+        out[off[m] + nv[m] - 1 - k] = ((delta[m] >> (7 * k)) & 0x7F) | (0x80 if k else 0)
+    pos = off + nv
+    out[pos] = hi | ev["channel"]
+    out[pos + 1] = ev["data1"]
+    two = nd == 2
+    out[pos[two] + 2] = ev["data2"][two]
+    return out.tobytes()
+
+def _mtrk(body):
+    body = body + b"\x00\xff\x2f\x00"  # End of Track
+    return b"MTrk" + struct.pack(">I", len(body)) + body
+
+class SeekIndex:
+    """
+    シーク用の前処理結果（ファイルごとに1回だけ作る）。
+    - events: 全トラックを時刻順に並べ直したイベント表
+    - tempo_map: 秒 <-> tick 変換
+    - snapshots: SNAPSHOT_SECONDS 秒 / SNAPSHOT_EVENTS 件ごとの ChannelState。
+      任意位置の状態は直前のスナップショット + 差分だけで作れる
+    """
+    def __init__(self, table):
+        self.path = table.path
+        self.division = table.ticks_per_beat
+        self.events = table.events[np.argsort(table.events["tick"], kind="stable")]
+        self.metas = sorted(table.metas, key=lambda e: e[0])
+        tempos, _ts, _keys = _decode_meta_maps(self.metas)
+        self.tempo_map = TempoMap(tempos, self.division)
+        st = self.events["status"]
+        self.state_events = self.events[(st == 0xB0) | (st == 0xC0) | (st == 0xE0)]
+        self._build_snapshots()
+        self._event_seconds = None
+
+    def event_seconds(self):
+        """events の各イベントの時刻（秒）。初回だけ計算する。"""
+        if self._event_seconds is None:
+            self._event_seconds = self.tempo_map.ticks_to_seconds(self.events["tick"])
+        return self._event_seconds
+
+    def _build_snapshots(self):
+        ticks = self.state_events["tick"]
+        n = len(ticks)
+        end_sec = self.tempo_map.tick_to_seconds(int(self.events["tick"][-1])) if len(self.events) else 0.0
+        bounds = [self.tempo_map.seconds_to_tick(k * SNAPSHOT_SECONDS)
+                  for k in range(1, int(end_sec / SNAPSHOT_SECONDS) + 1)]
+        pos = set(np.searchsorted(ticks, bounds, side="left").tolist())
+        pos.update(range(SNAPSHOT_EVENTS, n, SNAPSHOT_EVENTS))
+        self.snap_pos = [0]
+        self.snapshots = [ChannelState()]
+        for p in sorted(pos):
+            if p <= self.snap_pos[-1] or p > n:
+                continue
+            self.snapshots.append(self.snapshots[-1].copy().apply(self.state_events[self.snap_pos[-1]:p]))
+            self.snap_pos.append(p)
+
+    def channel_state(self, tick):
+        """tick の直前までを再生し終えた時点の ChannelState（二分探索 + 差分の再生）。"""
+        k = int(np.searchsorted(self.state_events["tick"], tick, side="left"))
+        j = bisect_right(self.snap_pos, k) - 1
+        return self.snapshots[j].copy().apply(self.state_events[self.snap_pos[j]:k])
+
+    def state_at(self, tick):
+        """tick 時点のチャンネル状態を再現するメッセージ列。"""
+        return self.channel_state(tick).messages()
+
+    def instruments_at(self, seconds):
+        """
+        seconds 時点の楽器を extract_instruments と同じ形式 {ch: (bank, prog, name)} で返す。
+        ノートのあるチャンネルだけ。その tick ちょうどのチェンジも反映する。
+        """
+        st = self.channel_state(self.tempo_map.seconds_to_tick(seconds) + 1)
+        ev = self.events
+        used = {}
+        for ch in np.unique(ev["channel"][ev["status"] == 0x90]).tolist():
+            if ch == 9:
+                used[10] = (128, 0, "Drums (Standard Kit)")
+                continue
+            pg = max(0, int(st.program[ch]))
+            bank = max(0, int(st.cc[ch, 0])) * 128 + max(0, int(st.cc[ch, 32]))
+            used[ch + 1] = (bank, pg, GM_PROGRAMS[pg] if pg < 128 else f"Program {pg}")
+        return used
+
+    def write_from(self, seconds, out_path):
+        """
+        seconds から始まる SMF（format 1）を out_path に書く。
+        track 0: その時点のテンポ/拍子/調 + 以降のメタ、track 1: 状態の復元 + 以降のイベント。
+        鳴りかけのノートとシステムエクスクルーシブは引き継がない。
+        Returns the start tick.
+        """
+        tick = self.tempo_map.seconds_to_tick(seconds)
+
+        conductor = {}
+        later = []
+        for t, _trk, mtype, payload in self.metas:
+            if t < tick:
+                if mtype in (0x51, 0x58, 0x59):
+                    conductor[mtype] = payload
+            else:
+                later.append((t - tick, mtype, payload))
+        body = bytearray()
+        for mtype, payload in sorted(conductor.items()):
+            body += b"\x00\xff" + bytes([mtype]) + _vlq(len(payload)) + payload
+        prev = 0
+        for t, mtype, payload in later:
+            body += _vlq(t - prev) + b"\xff" + bytes([mtype]) + _vlq(len(payload)) + payload
+            prev = t
+
+        chase = bytearray()
+        for st, ch, d1, d2 in self.state_at(tick):
+            chase += b"\x00" + bytes([st | ch, d1]) + (b"" if st in (0xC0, 0xD0) else bytes([d2]))
+        k = int(np.searchsorted(self.events["tick"], tick, side="left"))
+        rest = self.events[k:].copy()
+        rest["tick"] -= tick
+        notes = chase + _encode_channel_events(rest)
+
+        division = struct.pack(">h", self.division)
+        with open(out_path, "wb") as f:
+            f.write(b"MThd" + struct.pack(">IHH", 6, 1, 2) + division)
+            f.write(_mtrk(bytes(body)))
+            f.write(_mtrk(bytes(notes)))
+        return tick
+
+def build_seek_index(midi_path):
+    return SeekIndex(read_midi_events(midi_path))
+
+def preload_track(midi_path, cache=None):
+    """連続再生用：次の曲の解析（キャッシュにも載せる）と SeekIndex を先に作っておく。"""
+    a = analyze_midi_cached(midi_path, cache) if _HAVE_ANALYZER else None
+    idx = build_seek_index(midi_path) if _HAVE_NUMPY else None
+    return midi_path, a, idx
+
+def parse_time_text(text):
+    """'83.5' / '1:23' / '1:02:03' → 秒。空なら 0。"""
+    text = (text or "").strip()
+    if not text:
+        return 0.0
+    sec = 0.0
+    for part in text.split(":"):
+        sec = sec * 60 + float(part)
+    if sec < 0:
+        raise ValueError("開始位置は 0 以上で指定してください。")
+    return sec
+
+def format_time(sec):
+    sec = int(max(0, sec))
+    return f"{sec // 60}:{sec % 60:02d}"
+
+# ---------- Playback clock ----------
+class PlaybackClock:
+    """
+    曲中の再生位置（秒）を perf_counter から求める単調時計。一時停止・再開・シークを反映する。
+    進める・止めるのは再生エンジン（シンセが実際に鳴り始めた／止まったとき）。
+    経過時間の表示も server エンジンのシーケンサもこの時計を見るので、表示と発音がずれない。
+    シンセ側の位置が分かるエンジンでは sync() で寄せる。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._t0 = 0.0        # perf_counter() - 曲中の秒（進んでいる間）
+        self._pos = 0.0       # 止まっている間の位置
+        self._ticking = False
+
+    def position(self):
+        with self._lock:
+            return time.perf_counter() - self._t0 if self._ticking else self._pos
+
+    @property
+    def ticking(self):
+        return self._ticking
+
+    def start(self, from_sec=0.0):
+        with self._lock:
+            self._t0 = time.perf_counter() - from_sec
+            self._ticking = True
+
+    def pause(self):
+        with self._lock:
+            if self._ticking:
+                self._pos = time.perf_counter() - self._t0
+                self._ticking = False
+
+    def stop(self):
+        self.pause()
+
+    def reset(self, sec=0.0):
+        """止めた状態で位置を sec にする。進め始めるのは音が出始めたときに再生エンジンが resume() で。"""
+        with self._lock:
+            self._pos = sec
+            self._ticking = False
+
+    def resume(self):
+        with self._lock:
+            if not self._ticking:
+                self._t0 = time.perf_counter() - self._pos
+                self._ticking = True
+
+    def seek(self, sec):
+        with self._lock:
+            if self._ticking:
+                self._t0 = time.perf_counter() - sec
+            else:
+                self._pos = sec
+
+    def shift(self, sec):
+        """位置を sec だけ戻す（連続再生で次の曲の頭を 0 秒にする）。進み方は途切れない。"""
+        with self._lock:
+            self._t0 += sec
+            self._pos -= sec
+
+    def sync(self, sec, tolerance=0.005):
+        """外部（シンセ側）の位置 sec から tolerance 以上ずれていたら合わせる。"""
+        if abs(self.position() - sec) > tolerance:
+            self.seek(sec)
+
+# ---------- Playback backends ----------
+class GainRamp:
+    """
+    ゲインを一度に変えず、duration 秒かけて少しずつ寄せる（スライダー操作でジッパーノイズを出さない）。
+    set() は何度呼んでもよく、1本のスレッドが最後に指定された値へ向かって apply(gain) を呼び続ける。
+    """
+    STEP_SEC = 0.01
+
+    def __init__(self, apply, gain, duration=0.08):
+        self.apply = apply          # gain -> None（シンセへ実際に送る）
+        self.duration = duration
+        self.current = float(gain)  # 最後に送った値
+        self.target = float(gain)
+        self._step = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def set(self, gain):
+        with self._lock:
+            self.target = float(gain)
+            self._step = abs(self.target - self.current) * self.STEP_SEC / self.duration
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="mhp-gain-ramp", daemon=True)
+                self._thread.start()
+
+    def jump(self, gain):
+        """ランプせずにすぐ合わせる（曲の頭など、鳴っていないとき用）。"""
+        self.cancel()
+        with self._lock:
+            self.current = self.target = float(gain)
+        self.apply(self.current)
+
+    def cancel(self):
+        """動いているランプをその場で止める（シンセを消す前に呼ぶ）。"""
+        with self._lock:
+            self.target = self.current
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                d = self.target - self.current
+                done = abs(d) <= self._step
+                self.current = self.target if done else self.current + (self._step if d > 0 else -self._step)
+                gain = self.current
+                if done:
+                    self._thread = None
+            try:
+                self.apply(gain)
+            except Exception:
+                pass  # シンセが落ちている等。次の set / 立て直しで合う
+            if done:
+                return
+            time.sleep(self.STEP_SEC)
+
+class SynthNotFoundError(Exception):
+    """fluidsynth の実行ファイル / ライブラリが見つからない。"""
+
+class SynthCrashedError(Exception):
+    """常駐 fluidsynth が応答しない / 終了している。"""
+
+class ProcessReaper:
+    """
+    終了させた fluidsynth の後始末（終わるのを待つ・居座れば kill・回収）を1本のスレッドで引き受ける。
+    stop() は terminate() を投げたらすぐ戻れるので、Tk スレッドが待たされず、ゾンビも残らない。
+    """
+    def __init__(self):
+        self._q = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def reap(self, proc, grace=1.0):
+        """grace 秒待っても終わらなければ kill する。"""
+        self._q.put((proc, time.monotonic() + grace))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="mhp-reaper", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            proc, deadline = self._q.get()
+            try:
+                proc.wait(timeout=max(deadline - time.monotonic(), 0.0))
+            except subprocess.TimeoutExpired:
+                try:
+                    proc.kill()
+                    proc.wait(timeout=5.0)
+                except Exception:
+                    pass
+            except Exception:
+                pass
+
+_reaper = ProcessReaper()
+
+PLAYER_CMD_VERSION = (2, 2, 0)  # shell の player_stop / player_cont が入った fluidsynth
+_fs_versions = {}  # 実行ファイル -> (major, minor, patch) か None
+
+def fluidsynth_version(exe):
+    """fluidsynth --version の版を返す（実行ファイルごとに1回だけ調べる）。分からなければ None。"""
+    if exe not in _fs_versions:
+        ver = None
+        try:
+            out = subprocess.run([exe, "--version"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, timeout=10.0,
+                                 creationflags=(subprocess.CREATE_NEW_PROCESS_GROUP if os.name == "nt" else 0)).stdout
+            m = re.search(rb"(\d+)\.(\d+)\.(\d+)", out)
+            if m:
+                ver = tuple(int(x) for x in m.groups())
+        except (OSError, subprocess.SubprocessError):
+            pass  # 見つからない等。起動時に SynthNotFoundError になる
+        _fs_versions[exe] = ver
+    return _fs_versions[exe]
+
+class ProcessBackend:
+    """
+    曲ごとに fluidsynth を起動する従来方式（2.0.0 concept）。
+    get_index（numpy、かつ player_stop / player_cont のある fluidsynth 2.2 以降）があれば、
+    起動時に渡したファイルを fluidsynth の shell（stdin パイプ）で操作する。
+    一時停止/再開は player_stop / player_cont で、プロセスも SoundFont もそのまま（起動し直さない）。
+    時計は shell の準備ができて鳴り始めてから進め、曲の終わりは SeekIndex の最後のイベント時刻で決める
+    （shell モードの fluidsynth は曲が終わっても終了しないため）。
+    get_index が無いときは -ni で起動してプロセスの終了を曲の終わりとし、一時停止は SIGSTOP / suspend。
+    """
+    kind = "process"
+    on_end = None        # 曲が最後まで再生されたとき（stop では呼ばない）に別スレッドから呼ばれる
+    on_driver_failed = None  # (鳴らし続けているドライバ, 開けなかったドライバ, 理由)。set_driver の失敗時に別スレッドから
+
+    def __init__(self, build_cmd, clock, write_seek_file=None, get_index=None):
+        self.build_cmd = build_cmd              # (midi_path, shell) -> fluidsynth の引数列
+        self.clock = clock                      # アプリと共有する PlaybackClock（鳴り始め・一時停止・再開で進める/止める）
+        self.write_seek_file = write_seek_file  # (midi_path, sec) -> 一時 .mid のパス
+        self.get_index = get_index              # midi_path -> SeekIndex（曲の長さを知るため。start で Tk スレッドから呼ぶ）
+        self.native_seek = write_seek_file is not None
+        self.needs_index = get_index is not None  # アプリは SeekIndex を seek_worker で作ってから start する
+        self.shell = None   # get_index があるとき：FluidsynthShell
+        self.driver = None  # shell が使っているドライバ
+        self._swap = None   # set_driver() で裏で起動中の FluidsynthShell
+        self.proc = None    # get_index が無いとき：-ni で起動した fluidsynth
+        self.key = None
+        self._gen = 0  # 起動し直す/止めるたびに進める。監視スレッドはこれで自然終了かどうかを見分ける
+        self._midi = None
+        self._end = None   # shell モードの曲の終わり（最後のイベント時刻、秒）
+        self._lock = threading.Lock()  # _gen / _paused / _ready と時計の操作をそろえる
+        self._paused = False
+        self._ready = False     # shell が動き出し、時計を進め始めた
+        self._finished = False  # 最後まで鳴らした（on_end を呼ぶ前に立てる）
+        self._frozen = False    # get_index が無いときの SIGSTOP / suspend
+        self._ramp = GainRamp(lambda g: self.shell.send(f"gain {g:.3f}"), 0.0)
+
+    def start(self, midi_path, gain, from_sec=0.0):
+        """時計は from_sec で止めておくこと（reset）。鳴り始めたらここで進め始める。"""
+        self.stop()
+        self._midi = midi_path
+        self._finished = False
+        if self.get_index is not None:
+            try:
+                times = self.get_index(midi_path).event_seconds()  # アプリが作り終えているので引くだけ
+                self._end = float(times[-1]) if len(times) else 0.0
+            except Exception:
+                self._end = None  # 長さが分からない：落ちるか止められるまで鳴らす
+        if from_sec > 0 and self.write_seek_file is not None:
+            midi_path = self.write_seek_file(midi_path, from_sec)
+        self._launch(midi_path)
+        if self.shell is not None:
+            self._ramp.jump(gain)  # -g と同じ値。以降の set_gain はここからランプする
+
+    def _launch(self, midi_path):
+        if self.get_index is not None:
+            cmd = self.build_cmd(midi_path, shell=True)
+            self.shell = FluidsynthShell(cmd)  # gain は -g で渡る
+            self.driver = cmd[cmd.index("-a") + 1]
+            threading.Thread(target=self._watch_shell, args=(self.shell, self._gen, self._end),
+                             name="mhp-proc-watch", daemon=True).start()
+            return
+        cmd = self.build_cmd(midi_path, shell=False)
+        try:
+            creation = (subprocess.CREATE_NEW_PROCESS_GROUP if os.name == "nt" else 0)
+            self.proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                creationflags=creation,
+                close_fds=True,
+            )
+        except FileNotFoundError:
+            raise SynthNotFoundError()
+        self.clock.resume()  # 準備ができたか知るすべが無いので起動と同時に
+        threading.Thread(target=self._watch, args=(self.proc, self._gen), name="mhp-proc-watch", daemon=True).start()
+
+    def _watch(self, proc, gen):
+        # 終了検知専用：wait() で寝て待つのでポーリングしない
+        proc.wait()
+        if gen == self._gen and self.on_end is not None:
+            self.on_end()
+
+    def _watch_shell(self, shell, gen, end):
+        """準備ができたら時計を進め、end（最後のイベント時刻）を過ぎるか落ちたら終了とする。"""
+        try:
+            shell.wait_ready()
+        except SynthCrashedError:
+            pass  # 起動に失敗した。下で終了扱い
+        else:
+            with self._lock:
+                if gen != self._gen:
+                    return
+                self._ready = True
+                if not self._paused:
+                    self.clock.resume()
+            while True:
+                left = None if end is None else end - self.clock.position()
+                if left is not None and left <= 0:
+                    break
+                if shell.wait_exit(left):  # 一時停止中は時計が進まないので、待ち直すだけ
+                    break
+        with self._lock:
+            if gen != self._gen:
+                return  # stop / 起動し直し
+            self._finished = True
+        shell.kill()
+        if self.on_end is not None:
+            self.on_end()
+
+    def is_finished(self):
+        if self.shell is not None:
+            return self._finished
+        return self.proc is None or self.proc.poll() is not None
+
+    def pause(self):
+        if self.shell is not None:
+            with self._lock:
+                self._paused = True
+                self.clock.pause()
+            self.shell.send("player_stop")  # 位置は fluidsynth の player が保持する
+            self.shell.sound_off()
+            return
+        if self.proc is None:
+            return
+        self._freeze()
+        self.clock.pause()
+
+    def resume(self):
+        if self.shell is not None:
+            self.shell.send("player_cont")
+            with self._lock:
+                self._paused = False
+                if self._ready:
+                    self.clock.resume()  # まだ準備中なら、準備ができたときに監視スレッドが進める
+            return
+        if self._frozen:
+            self._thaw(self.proc)
+            self.clock.resume()
+
+    def _freeze(self):
+        # numpy が無い / fluidsynth が 2.2 より前で shell で操作できないときだけの旧方式
+        if os.name == "nt":
+            if not _HAVE_PSUTIL:
+                raise RuntimeError("process エンジンの一時停止には numpy と fluidsynth 2.2 以降、または psutil が必要です。\n\n"
+                                   "pip install numpy（fluidsynth が古いときは pip install psutil）")
+            psutil.Process(self.proc.pid).suspend()
+        else:
+            os.kill(self.proc.pid, signal.SIGSTOP)
+        self._frozen = True
+
+    def _thaw(self, proc):
+        self._frozen = False
+        if os.name == "nt":
+            psutil.Process(proc.pid).resume()
+        else:
+            os.kill(proc.pid, signal.SIGCONT)
+
+    def set_gain(self, gain):
+        if self.shell is not None:
+            self._ramp.set(gain)
+        # -ni で起動したものは操作できないので、次の起動で -g から効く
+
+    def set_driver(self, driver):
+        """
+        build_cmd は新しいドライバを使うので、今の位置からもう1つ（音量 0 で）起動しておく。
+        SoundFont を読み終えてドライバが開けたと分かるまでは今の fluidsynth で鳴らし続け、
+        準備ができたら監視スレッドが今の位置へ player_seek して音量を戻し、古い方を止める（Tk スレッドは待たない）。
+        立ち上がらなければ古い方のまま鳴らし続け、on_driver_failed で知らせる。
+        """
+        if self.shell is None or self.write_seek_file is None:
+            return  # -ni で起動したものは次の再生から
+        pos = self.clock.position()
+        index = self.get_index(self._midi)
+        base = index.tempo_map.seconds_to_tick(pos)  # 一時 .mid の 0 tick
+        cmd = self.build_cmd(self.write_seek_file(self._midi, pos) if pos > 0 else self._midi, shell=True)
+        cmd[cmd.index("-g") + 1] = "0"  # 読み込み中に進んだ分は古い方が鳴らしているので、差し替えるまで無音で
+        swap = FluidsynthShell(cmd)
+        with self._lock:
+            unused, self._swap = self._swap, swap
+            gen = self._gen
+        if unused is not None:
+            unused.kill()  # 連続で切り替えた場合、使われなかった方
+        threading.Thread(target=self._swap_shell, args=(swap, gen, index, base, driver),
+                         name="mhp-proc-swap", daemon=True).start()
+
+    def _swap_shell(self, swap, gen, index, base, driver):
+        """set_driver() の続き（別スレッド）：新しい shell の準備を待って差し替える。"""
+        try:
+            swap.wait_ready()
+            reason = None
+        except SynthCrashedError as e:
+            reason = str(e)
+        old = None
+        with self._lock:
+            current = self._swap is swap and gen == self._gen
+            if current:
+                self._swap = None
+            if current and reason is None:
+                tick = max(index.tempo_map.seconds_to_tick(self.clock.position()) - base, 0)
+                cmds = [f"player_seek {tick}"] + [f"cc {ch} 120 0" for ch in range(16)]
+                if self._paused:
+                    cmds.append("player_stop")
+                try:
+                    swap.send(cmds + [f"gain {self._ramp.current:.3f}"])
+                except SynthCrashedError as e:
+                    reason = str(e)
+                else:
+                    old, self.shell = self.shell, swap
+                    self.driver = driver
+                    self._gen += 1  # 古い方の監視スレッドを終わらせる
+                    threading.Thread(target=self._watch_shell, args=(swap, self._gen, self._end),
+                                     name="mhp-proc-watch", daemon=True).start()
+        if old is not None:
+            old.kill()
+            return
+        swap.kill()
+        if current and self.on_driver_failed is not None:
+            self.on_driver_failed(self.driver, driver, reason)
+
+    def stop(self):
+        with self._lock:
+            self._paused = False
+        self._stop_proc()
+
+    def _stop_proc(self):
+        with self._lock:
+            self._gen += 1
+            self._ready = False
+            swap, self._swap = self._swap, None
+        if swap is not None:
+            swap.kill()  # set_driver() で裏で起動中だったもの
+        shell, self.shell = self.shell, None
+        if shell is not None:
+            shell.kill()  # quit を送る。終了待ちと回収は reaper に任せる
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        if self._frozen:
+            try:
+                self._thaw(proc)  # 一時停止中でも終了できるように（self.proc はもう None）
+            except Exception:
+                pass
+        try:
+            proc.terminate()  # 音はここで止まる。終了待ちと回収は reaper に任せる
+        except Exception:
+            pass
+        _reaper.reap(proc)
+
+    def close(self):
+        self.stop()
+        self._ramp.cancel()
+
+_pyfluidsynth = None
+
+def _import_pyfluidsynth(exe_dir=None):
+    """
+    pyfluidsynth を遅延 import する。Windows では選択済み fluidsynth.exe のフォルダから
+    libfluidsynth の DLL を探せるようにしておく。
+    """
+    global _pyfluidsynth
+    if _pyfluidsynth is None:
+        if os.name == "nt" and exe_dir and os.path.isdir(exe_dir):
+            try:
+                os.add_dll_directory(exe_dir)
+            except Exception:
+                pass
+            os.environ["PATH"] = exe_dir + os.pathsep + os.environ.get("PATH", "")
+        try:
+            import fluidsynth as fl
+        except Exception as e:
+            raise SynthNotFoundError(f"pyfluidsynth / libfluidsynth を読み込めません: {e}")
+        _pyfluidsynth = fl
+    return _pyfluidsynth
+
+def _fl_func(fl, name, restype, *argtypes):
+    """pyfluidsynth が公開していない libfluidsynth の関数も ctypes で引けるようにする。"""
+    f = getattr(fl, name, None)
+    if f is not None:
+        return f
+    f = getattr(fl._fl, name)
+    f.restype = restype
+    f.argtypes = list(argtypes)
+    return f
+
+FLUID_PLAYER_PLAYING = 1
+
+class InProcessBackend:
+    """
+    pyfluidsynth で Synth と SoundFont をプロセス内に常駐させる方式。
+    曲を替えても SF2 の再読み込み・オーディオドライバの初期化は起きず、
+    fluid_player を作り直すだけで次の曲を鳴らせる。
+    """
+    kind = "inprocess"
+    native_seek = False
+    needs_index = False
+    on_end = None
+
+    def __init__(self, exe, sf2, driver, gain, clock):
+        fl = _import_pyfluidsynth(os.path.dirname(exe) if os.path.isabs(exe) else None)
+        self.key = None
+        self.clock = clock  # アプリと共有する PlaybackClock
+        self._new_player = _fl_func(fl, "new_fluid_player", ctypes.c_void_p, ctypes.c_void_p)
+        self._delete_player = _fl_func(fl, "delete_fluid_player", None, ctypes.c_void_p)
+        self._player_add = _fl_func(fl, "fluid_player_add", ctypes.c_int, ctypes.c_void_p, ctypes.c_char_p)
+        self._player_play = _fl_func(fl, "fluid_player_play", ctypes.c_int, ctypes.c_void_p)
+        self._player_stop = _fl_func(fl, "fluid_player_stop", ctypes.c_int, ctypes.c_void_p)
+        self._player_join = _fl_func(fl, "fluid_player_join", ctypes.c_int, ctypes.c_void_p)
+        self._player_status = _fl_func(fl, "fluid_player_get_status", ctypes.c_int, ctypes.c_void_p)
+        self._system_reset = _fl_func(fl, "fluid_synth_system_reset", ctypes.c_int, ctypes.c_void_p)
+        self._synth_set_gain = _fl_func(fl, "fluid_synth_set_gain", None, ctypes.c_void_p, ctypes.c_float)
+        self._delete_driver = _fl_func(fl, "delete_fluid_audio_driver", None, ctypes.c_void_p)
+        try:
+            self._player_tick = _fl_func(fl, "fluid_player_get_current_tick", ctypes.c_int, ctypes.c_void_p)
+        except AttributeError:
+            self._player_tick = None  # fluidsynth 2.1 より前
+        self.fs = fl.Synth(gain=gain)
+        self.fs.start(driver=driver)
+        self.sfid = self.fs.sfload(sf2)
+        if self.sfid == -1:
+            self.fs.delete()
+            raise RuntimeError(f"SoundFont を読み込めません: {sf2}")
+        self._ramp = GainRamp(lambda g: self._synth_set_gain(self.fs.synth, g), gain)
+        self.player = None
+        self._paused = False
+        self._lock = threading.Lock()
+        self._resumed = threading.Event()
+        self._watchers = 0      # 動いている監視スレッドの数（それぞれが自分の player を消す）
+        self._closed = False    # close() 済み。最後の監視スレッドが Synth も消す
+
+    def start(self, midi_path, gain, from_sec=0.0):
+        self.stop()
+        self._ramp.jump(gain)
+        self._system_reset(self.fs.synth)  # 前の曲のプログラム/CC を持ち越さない
+        player = self._new_player(self.fs.synth)
+        if not player:
+            raise RuntimeError("fluid_player を作成できません。")
+        if self._player_add(player, os.fsencode(midi_path)) != 0 or self._player_play(player) != 0:
+            self._delete_player(player)
+            raise RuntimeError(f"MIDI を再生できません: {midi_path}")
+        self.player = player
+        self._paused = False
+        self.clock.resume()  # Synth は常駐していて、play した時点で鳴り始める
+        with self._lock:
+            self._watchers += 1
+        threading.Thread(target=self._watch, args=(player,), name="mhp-player-watch", daemon=True).start()
+
+    def _watch(self, player):
+        """
+        終了検知専用スレッド。fluid_player_join で寝て待つ。
+        join 中に player を消さないよう、delete_fluid_player もこのスレッドが行う。
+        close() 済みで最後の1本なら、player を消した後に Synth も消す（close() は待たずに戻るため）。
+        """
+        while True:
+            self._player_join(player)
+            if self.player is not player:
+                break  # stop された
+            if self._paused:
+                self._resumed.wait()  # pause で join が返っただけ。再開（か stop）を待つ
+                continue
+            with self._lock:
+                ended = self.player is player
+                if ended:
+                    self.player = None
+            if ended and self.on_end is not None:
+                self.on_end()
+            break
+        self._delete_player(player)
+        with self._lock:
+            self._watchers -= 1
+            last = self._closed and not self._watchers
+        if last:
+            self.fs.delete()
+
+    def set_gain(self, gain):
+        self._ramp.set(gain)
+
+    def set_driver(self, driver):
+        """
+        オーディオドライバだけ作り直す。Synth と fluid_player はそのままなので、位置も音色も保たれる
+        （プレイヤーはシンセのサンプル数で進むので、ドライバが無い間は止まっている）。
+        """
+        if self.fs.audio_driver:
+            self._delete_driver(self.fs.audio_driver)
+            self.fs.audio_driver = None
+        self.fs.start(driver=driver)
+        if not self.fs.audio_driver:
+            raise RuntimeError(f"オーディオドライバを開けません: {driver}")
+
+    def _sound_off(self):
+        for ch in range(16):
+            self.fs.cc(ch, 120, 0)  # All Sound Off
+
+    def is_finished(self):
+        if self.player is None:
+            return True
+        return not self._paused and self._player_status(self.player) != FLUID_PLAYER_PLAYING
+
+    def current_tick(self):
+        """プレイヤーが今いる tick（再生中のファイル内）。分からなければ None。"""
+        if self.player is None or self._player_tick is None:
+            return None
+        return self._player_tick(self.player)
+
+    def pause(self):
+        if self.player is not None:
+            self._paused = True  # 監視スレッドが自然終了と取り違えないよう先に立てる
+            self._resumed.clear()
+            self._player_stop(self.player)  # 位置は保持される
+            self.clock.pause()
+            self._sound_off()
+
+    def resume(self):
+        if self.player is not None:
+            self._player_play(self.player)
+            self.clock.resume()
+            self._paused = False
+            self._resumed.set()
+
+    def stop(self):
+        with self._lock:
+            player, self.player = self.player, None
+        self._paused = False
+        if player is not None:
+            self._player_stop(player)
+            self._sound_off()
+        self._resumed.set()  # 一時停止中の監視スレッドを起こす（player の後始末はそちらで）
+
+    def close(self):
+        """止めてすぐ戻る（join しない）。監視スレッドが残っていれば Synth の削除はそちらに任せる。"""
+        self.stop()
+        self._ramp.cancel()
+        with self._lock:
+            self._closed = True
+            idle = not self._watchers
+        if idle:
+            self.fs.delete()
+
+class FluidsynthShell:
+    """
+    fluidsynth を shell モードで1つだけ常駐させ、stdin パイプにコマンドを書き込む。
+    SoundFont の読み込みとオーディオドライバの初期化は起動時の1回だけ。
+    起動直後は SoundFont の読み込み中で、その間に送ったコマンドは読み込み後にまとめて実行される。
+    鳴らし始める前に wait_ready() で echo の返事（= shell が動き出した）を待つこと。
+    プロセスが落ちていたら send() が SynthCrashedError を投げるので restart() で立て直す。
+    """
+    READY_MARK = b"mhp-ready"
+    READY_TIMEOUT = 60.0  # 大きい SF2 の読み込みを待つ上限（秒）
+
+    def __init__(self, cmd):
+        self.cmd = cmd  # fluidsynth の引数列（-i を付けない）
+        self.proc = None
+        self._ready = threading.Event()
+        self._exited = threading.Event()
+        self._lock = threading.Lock()
+        self.restart()
+
+    def restart(self):
+        self.kill()
+        self._ready = threading.Event()
+        self._exited = threading.Event()
+        try:
+            creation = (subprocess.CREATE_NEW_PROCESS_GROUP if os.name == "nt" else 0)
+            self.proc = subprocess.Popen(
+                self.cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                creationflags=creation,
+                close_fds=True,
+            )
+        except FileNotFoundError:
+            raise SynthNotFoundError()
+        threading.Thread(target=self._drain, args=(self.proc, self._ready, self._exited),
+                         name="mhp-shell-out", daemon=True).start()
+        self.send("echo " + self.READY_MARK.decode())
+
+    def _drain(self, proc, ready, exited):
+        """stdout（プロンプトや返事）を読み捨て続ける（パイプを詰まらせない）。READY_MARK が来たら準備完了。"""
+        tail = b""
+        try:
+            for chunk in iter(lambda: proc.stdout.read1(4096), b""):
+                if not ready.is_set():
+                    tail = (tail + chunk)[-64:]
+                    if self.READY_MARK in tail:
+                        ready.set()
+        except (OSError, ValueError):
+            pass
+        exited.set()
+        ready.set()  # 終了した。待っている側は alive() で見分ける
+
+    def is_ready(self):
+        """起動処理が終わったか（落ちた場合も True になるので alive() で見分ける）。待たない。"""
+        return self._ready.is_set()
+
+    def wait_ready(self, stop=None, timeout=None):
+        """
+        SoundFont を読み終えてコマンドをすぐ実行できるようになるまで待つ。
+        stop（Event）が立ったら False。落ちた・時間切れなら SynthCrashedError。
+        """
+        ready = self._ready
+        deadline = time.monotonic() + (timeout or self.READY_TIMEOUT)
+        while not ready.wait(0.05):
+            if stop is not None and stop.is_set():
+                return False
+            if time.monotonic() > deadline:
+                raise SynthCrashedError("fluidsynth が応答しません（SoundFont の読み込みが終わらない）。")
+        if not self.alive():
+            raise SynthCrashedError("fluidsynth が起動直後に終了しました。")
+        return True
+
+    def wait_exit(self, timeout=None):
+        """プロセスが終了するまで（最大 timeout 秒）寝て待つ。終了していれば True。"""
+        return self._exited.wait(timeout)
+
+    def alive(self):
+        # stdout が閉じたらもう終わりかけ（poll() がまだ None を返す間も落ちた扱いにする）
+        return self.proc is not None and not self._exited.is_set() and self.proc.poll() is None
+
+    def send(self, lines):
+        """コマンド（文字列 or そのリスト）を1回の write でまとめて送る。"""
+        if isinstance(lines, str):
+            lines = [lines]
+        if not lines:
+            return
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        with self._lock:
+            if not self.alive():
+                raise SynthCrashedError("fluidsynth が終了しています。")
+            try:
+                self.proc.stdin.write(data)
+                self.proc.stdin.flush()
+            except (OSError, ValueError) as e:
+                raise SynthCrashedError(str(e))
+
+    def sound_off(self):
+        self.send([f"cc {ch} 120 0" for ch in range(16)])  # All Sound Off
+
+    def kill(self):
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.write(b"quit\n")
+            proc.stdin.close()
+        except Exception:
+            pass
+        _reaper.reap(proc, grace=0.5)
+
+def _shell_commands(ev):
+    """チャンネルイベント → fluidsynth shell コマンド（shell に無い Aftertouch 系は捨てる）。"""
+    out = []
+    for st, ch, d1, d2 in zip(ev["status"].tolist(), ev["channel"].tolist(),
+                              ev["data1"].tolist(), ev["data2"].tolist()):
+        if st == 0x90 and d2 > 0:
+            out.append(f"noteon {ch} {d1} {d2}")
+        elif st == 0x80 or st == 0x90:
+            out.append(f"noteoff {ch} {d1}")
+        elif st == 0xB0:
+            out.append(f"cc {ch} {d1} {d2}")
+        elif st == 0xC0:
+            out.append(f"prog {ch} {d1}")
+        elif st == 0xE0:
+            out.append(f"pitch_bend {ch} {(d2 << 7) | d1}")
+    return out
+
+def _state_commands(msgs):
+    out = []
+    for st, ch, d1, d2 in msgs:
+        if st == 0xB0:
+            out.append(f"cc {ch} {d1} {d2}")
+        elif st == 0xC0:
+            out.append(f"prog {ch} {d1}")
+        elif st == 0xE0:
+            out.append(f"pitch_bend {ch} {(d2 << 7) | d1}")
+    return out
+
+def _channel_reset_commands():
+    """
+    曲の継ぎ目で前の曲のチャンネル状態を戻すコマンド。reset（全ボイス即停止）と違い、鳴っている音は切らずに
+    自然に減衰させる（Reset All Controllers・音量/パン・バンク・プログラム・ピッチベンド中央）。
+    """
+    out = []
+    for ch in range(16):
+        out += [f"cc {ch} 121 0", f"cc {ch} 7 100", f"cc {ch} 10 64"]
+        if ch != 9:  # 9 はドラム。バンクを送るとメロディのバンクに変わるので触らない
+            out += [f"cc {ch} 0 0", f"cc {ch} 32 0"]
+        out += [f"prog {ch} 0", f"pitch_bend {ch} 8192"]
+    return out
+
+_FINE_SLEEP = os.name != "nt" or sys.version_info >= (3, 11)  # time.sleep が高分解能タイマーを使うか
+
+class ServerBackend:
+    """
+    常駐 fluidsynth（FluidsynthShell）に、Python 側のシーケンサースレッドが
+    SeekIndex のイベントを時刻どおりに送る方式。
+    曲の切り替え・シーク・一時停止はすべてコマンドで済み、プロセスの起動も
+    SoundFont の再読み込みも SIGSTOP も要らない。fluidsynth が落ちたら
+    立ち上げ直して、準備ができた時点の位置のチャンネル状態を送り直してから続きを鳴らす
+    （落ちていた間のノートは飛ばす。まとめて鳴らさない）。
+    時計はシンセの準備ができてから進め始める。
+    ドライバの切り替え（set_driver）は新しい fluidsynth の準備ができるまで古い方で鳴らし、同じ手順で差し替える。
+    queue() で次の曲を渡しておくと、最後のイベントの時刻からそのまま次の曲を続ける（隙間なし）。
+    """
+    kind = "server"
+    native_seek = True
+    needs_index = True
+    SPIN_SEC = 0.02  # これより短い待ちは Event.wait に任せない（Windows のタイマー粒度は約 15.6ms）
+    on_end = None
+    on_track = None  # queue() した曲に切り替わったとき、そのパスを渡して別スレッドから呼ばれる
+    on_driver_failed = None  # (鳴らし続けているドライバ, 開けなかったドライバ, 理由)。set_driver の失敗時に別スレッドから
+
+    def __init__(self, exe, sf2, driver, gain, get_index, clock):
+        self.exe = exe
+        self.sf2 = sf2
+        self.gain = gain
+        self.shell = FluidsynthShell(self._shell_cmd(driver))
+        self.driver = driver
+        self.get_index = get_index  # midi_path -> SeekIndex
+        self.clock = clock          # アプリと共有する PlaybackClock（準備ができたら進め、一時停止で止め、曲の継ぎ目でずらす）
+        self.key = None
+        self._ramp = GainRamp(lambda g: self.shell.send(f"gain {g:.3f}"), gain)
+        self._swap = None  # set_driver() で用意した次の (FluidsynthShell, ドライバ)
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._paused = False
+        self._ready = False     # シンセが鳴らせる状態になり、時計を進め始めた
+        self._lock = threading.Lock()  # _paused / _ready と時計の操作、送信と stop をそろえる
+        self._finished = False  # 最後まで送り終えた（on_end を呼ぶ前に立てる）
+        self._index = None
+        self._next = None  # (midi_path, SeekIndex)
+
+    def queue(self, midi_path, index):
+        """今の曲の次に続けて鳴らす曲を指定する（None で取り消し）。"""
+        self._next = (midi_path, index) if midi_path is not None else None
+
+    def start(self, midi_path, gain, from_sec=0.0):
+        """時計は from_sec で止めておくこと（reset）。シンセの準備ができたらここで進め始める。"""
+        self.stop()
+        self._next = None
+        index = self.get_index(midi_path)  # アプリは seek_worker で作り終えてから呼ぶ
+        self._ensure_shell()
+        self.gain = float(gain)
+        self.shell.send("reset")
+        self._ramp.jump(self.gain)
+        self._index = index
+        self._stop = threading.Event()
+        self._paused = False
+        self._ready = False
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, args=(index, from_sec, self._stop),
+                                        name="mhp-sequencer", daemon=True)
+        self._thread.start()
+
+    def _shell_cmd(self, driver):
+        return [self.exe, "-a", driver, "-g", f"{self.gain:.2f}", "-n", self.sf2]
+
+    def _ensure_shell(self):
+        if not self.shell.alive():
+            self.shell.restart()
+
+    def position(self):
+        """曲中の現在位置（秒）。"""
+        return self.clock.position()
+
+    def _run(self, index, from_sec, stop):
+        try:
+            if not self.shell.wait_ready(stop):
+                return  # 準備中に stop された
+        except SynthCrashedError:
+            pass  # 最初の送信で立て直しを試みる（だめなら終了扱い）
+        with self._lock:
+            if stop.is_set():
+                return  # stop された（次の曲の時計に触らない）
+            self._ready = True
+            if not self._paused:
+                self.clock.resume()
+        head = []
+        while True:
+            end = self._play(index, from_sec, stop, head)
+            if stop.is_set():
+                return
+            nxt, self._next = self._next, None
+            if end is None or nxt is None:
+                break
+            # 次の曲：時計の原点を前の曲の最後のイベント時刻ぶんずらすだけで、間を空けずに続ける
+            self.clock.shift(end)
+            path, index = nxt
+            self._index = index
+            from_sec = 0.0
+            head = _channel_reset_commands()  # reset だと前の曲の余韻（リリース・リバーブ）まで切れる
+            if self.on_track is not None:
+                self.on_track(path)
+        self._finished = True  # on_end を受けた側が is_finished() で確かめてもよいように先に立てる
+        if self.on_end is not None:
+            self.on_end()  # 最後まで送り終えた（または立て直せなかった）
+
+    def _play(self, index, from_sec, stop, head):
+        """1曲ぶん送る。最後まで送ったら最後のイベントの時刻（秒）、stop や立て直し失敗なら None。"""
+        ev = index.events
+        times = index.event_seconds()
+        n = len(ev)
+        i, state = self._state_from(index, times, from_sec)
+        pending = list(head) + state  # 途中からでも楽器/CC を合わせる
+        while not stop.is_set():
+            swap, driver = self._swap or (None, None)
+            if swap is not None and swap.is_ready():
+                # ドライバ切り替え：新しいシンセの準備ができたら移り、今の位置の状態から送り直す
+                self._swap = None
+                if swap.alive():
+                    old, self.shell = self.shell, swap
+                    self.driver = driver
+                    old.kill()
+                    i, state = self._state_from(index, times, self.position())
+                    pending = [f"gain {self._ramp.current:.3f}"] + state
+                else:
+                    swap.kill()  # 新しいドライバで起動できなかった。今のまま鳴らし続ける
+                    if self.on_driver_failed is not None:
+                        self.on_driver_failed(self.driver, driver, "fluidsynth が起動直後に終了しました。")
+            if self._paused:
+                self._wake.wait(0.05)
+                self._wake.clear()
+                continue
+            j = int(np.searchsorted(times, self.position(), side="right"))
+            if j > i:
+                pending += _shell_commands(ev[i:j])
+                i = j
+            if pending:
+                try:
+                    with self._lock:
+                        if stop.is_set():
+                            break  # stop() の sound_off より後には送らない
+                        self.shell.send(pending)
+                except SynthCrashedError:
+                    # 落ちたら立て直し、準備ができた時点の位置の状態から続ける（止まっていた間のノートは飛ばす）
+                    if stop.is_set():
+                        return None
+                    try:
+                        self.shell.restart()
+                        if not self.shell.wait_ready(stop):
+                            return None
+                    except Exception:
+                        return None
+                    i, state = self._state_from(index, times, self.position())
+                    # gain はランプ途中の値から（目標値へ飛ぶとランプが戻って聞こえる）
+                    pending = [f"gain {self._ramp.current:.3f}"] + state
+                    continue
+                pending = []
+            if i >= n:
+                return float(times[-1]) if n else 0.0
+            self._wait(times[i] - self.position())
+        return None
+
+    def _wait(self, delay):
+        """
+        delay 秒（か _wake が立つまで）待つ。Event.wait は OS のタイマー粒度でしか起きないので、
+        遠いときは SPIN_SEC 手前までだけ寝て、残りは perf_counter を見ながら短く刻んで待つ。
+        """
+        if delay > self.SPIN_SEC:
+            self._wake.wait(min(delay - self.SPIN_SEC, 0.05))
+        elif delay > 0:
+            deadline = time.perf_counter() + delay
+            while not self._wake.is_set():
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    break
+                # sleep(0.001) が 1ms で起きる環境（Windows は Python 3.11 から）なら寝て、最後の 2ms は譲るだけで回る
+                time.sleep(0.001 if left > 0.002 and _FINE_SLEEP else 0)
+        self._wake.clear()
+
+    def _state_from(self, index, times, sec):
+        """sec から送り始めるための (最初のイベント番号, その直前のチャンネル状態のコマンド)。"""
+        ev = index.events
+        i = int(np.searchsorted(times, sec, side="left"))
+        tick = int(ev["tick"][i]) if i < len(ev) else index.tempo_map.seconds_to_tick(sec)
+        return i, _state_commands(index.state_at(tick))
+
+    def is_finished(self):
+        return self._thread is None or self._finished
+
+    def pause(self):
+        if self._thread is None:
+            return
+        with self._lock:
+            self._paused = True
+            self.clock.pause()
+        self._wake.set()
+        self.shell.sound_off()
+
+    def resume(self):
+        if self._thread is None:
+            return
+        with self._lock:
+            self._paused = False
+            if self._ready:
+                self.clock.resume()  # まだ準備中なら、準備ができたときに _run が進める
+        self._wake.set()
+
+    def set_gain(self, gain):
+        self.gain = float(gain)
+        self._ramp.set(self.gain)
+
+    def set_driver(self, driver):
+        """
+        新しいドライバで fluidsynth をもう1つ立ち上げる。SoundFont を読み終えるまでは今のシンセで鳴らし続け、
+        準備ができたらシーケンサーが差し替える。時計は止めないので、切り替え後も同じ位置から続く。
+        """
+        shell = FluidsynthShell(self._shell_cmd(driver))
+        if self._thread is None or not self._thread.is_alive():
+            old, self.shell = self.shell, shell
+            self.driver = driver
+            old.kill()
+            return
+        unused, self._swap = self._swap, (shell, driver)
+        if unused is not None:
+            unused[0].kill()  # 連続で切り替えた場合、使われなかった方
+        self._wake.set()
+
+    def stop(self):
+        """
+        シーケンサーに止まるよう伝えてすぐ戻る（join しない）。
+        on_end / on_track は Tk のメインスレッド経由で届くので、ここで待つと曲の終わりと重なったときに固まる。
+        送信は _lock の中で stop を確かめてから行うので、ここを抜けた後にスレッドが音を出すことはない。
+        """
+        thread, self._thread = self._thread, None
+        self._paused = False
+        self._next = None
+        if thread is None:
+            return
+        with self._lock:
+            self._stop.set()
+        self._wake.set()
+        try:
+            self.shell.sound_off()
+        except SynthCrashedError:
+            pass
+
+    def close(self):
+        self.stop()
+        self._ramp.cancel()
+        if self._swap is not None:
+            self._swap[0].kill()
+            self._swap = None
+        self.shell.kill()
+
+# ---------- Batch render (headless) ----------
+def build_fluidsynth_cmd(exe, driver, gain, sf2, midi_path, shell=False):
+    """アプリの _build_cmd と同じ引数列。バッチ変換もここから作る。shell=True なら stdin のコマンドを受け付ける（-i なし）。"""
+    if not sf2 or not os.path.exists(sf2):
+        raise FileNotFoundError("SoundFont(.sf2) が未選択、または見つかりません。")
+    if not midi_path or not os.path.exists(midi_path):
+        raise FileNotFoundError("MIDI ファイルが見つかりません。")
+    return [exe or "fluidsynth", "-a", driver, "-g", f"{gain:.2f}", "-n" if shell else "-ni", sf2, midi_path]
+
+def _file_render_cmd(cmd, out_path):
+    """再生用の引数列の -a <driver> を -F <file> に差し替える（形式は拡張子から fluidsynth が判断）。"""
+    i = cmd.index("-a")
+    return cmd[:i] + ["-F", out_path] + cmd[i + 2:]
+
+def _render_one(cmd, out_path, timeout):
+    """1曲を書き出す。途中の .part は成功したときだけ本来の名前に置き換える（中断しても壊れたファイルを残さない）。"""
+    root, ext = os.path.splitext(out_path)
+    tmp = f"{root}.part{ext}"
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    t0 = time.perf_counter()
+    try:
+        r = subprocess.run(_file_render_cmd(cmd, tmp), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, timeout=timeout)
+        if r.returncode != 0 or not os.path.exists(tmp):
+            err = r.stderr.decode("utf-8", "replace").strip().splitlines()
+            return "failed", time.perf_counter() - t0, err[-1] if err else f"exit {r.returncode}"
+        os.replace(tmp, out_path)
+        return "ok", time.perf_counter() - t0, ""
+    except subprocess.TimeoutExpired:
+        return "timeout", time.perf_counter() - t0, f"{timeout:.0f}s を超えました"
+    except FileNotFoundError:
+        return "failed", time.perf_counter() - t0, "fluidsynth が見つかりません"
+    finally:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def batch_render(src_dir, out_dir, fmt="wav", jobs=None, timeout=600.0, cfg=None, log=print):
+    """
+    src_dir 以下の .mid/.midi を out_dir に同じフォルダ構成で書き出す。
+    設定（fluidsynth / SoundFont / gain）は mhp_config.json を使う。書き出し済みで MIDI より新しいものは飛ばすので、
+    中断後に同じコマンドを流せば続きから再開する。戻り値は {"ok": n, "skipped": n, "failed": [(path, msg)], ...}。
+    """
+    cfg = load_config() if cfg is None else cfg
+    exe = cfg.get("fluidsynth") or "fluidsynth"
+    sf2 = cfg.get("soundfont")
+    gain = float(cfg.get("gain", 0.8))
+    jobs = jobs or os.cpu_count() or 1
+
+    todo, skipped = [], 0
+    for dirpath, _, files in os.walk(src_dir):
+        for name in sorted(files):
+            if not name.lower().endswith((".mid", ".midi")):
+                continue
+            midi = os.path.join(dirpath, name)
+            rel = os.path.relpath(midi, src_dir)
+            out = os.path.join(out_dir, os.path.splitext(rel)[0] + "." + fmt)
+            if os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(midi):
+                skipped += 1
+                continue
+            todo.append((midi, out))
+    result = {"ok": 0, "skipped": skipped, "failed": [], "timeout": []}
+    log(f"{len(todo)} 曲を書き出します（{skipped} 曲は書き出し済み、{jobs} 並列）")
+    if not todo:
+        return result
+
+    t0 = time.perf_counter()
+    # 重い処理は fluidsynth の子プロセスなので、待つ側はスレッドで十分
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(_render_one, build_fluidsynth_cmd(exe, "file", gain, sf2, midi), out, timeout): midi
+                   for midi, out in todo}
+        done = 0
+        for fut in as_completed(futures):
+            midi = futures[fut]
+            status, took, msg = fut.result()
+            done += 1
+            if status == "ok":
+                result["ok"] += 1
+            else:
+                result[status if status == "timeout" else "failed"].append((midi, msg))
+            elapsed = time.perf_counter() - t0
+            eta = elapsed / done * (len(todo) - done)
+            log(f"[{done}/{len(todo)}] {status:7s} {os.path.relpath(midi, src_dir)} ({took:.1f}s)"
+                f"{'  ' + msg if msg else ''}  経過 {format_time(elapsed)} / 残り約 {format_time(eta)}")
+    return result
+
+def batch_main(argv):
+    ap = argparse.ArgumentParser(prog="Simple_midi_Player", description="MIDI フォルダを WAV/FLAC に一括変換（GUI なし）")
+    ap.add_argument("--batch", nargs=2, metavar=("MIDI_DIR", "OUT_DIR"), required=True)
+    ap.add_argument("--format", choices=["wav", "flac"], default="wav")
+    ap.add_argument("--jobs", type=int, default=None, help="同時に走らせる数（既定: CPU コア数）")
+    ap.add_argument("--timeout", type=float, default=600.0, help="1曲あたりの制限時間（秒）")
+    args = ap.parse_args(argv)
+    try:
+        r = batch_render(args.batch[0], args.batch[1], args.format, args.jobs, args.timeout)
+    except FileNotFoundError as e:
+        print(e)
+        return 2
+    print(f"完了: 成功 {r['ok']} / スキップ {r['skipped']} / 失敗 {len(r['failed'])} / タイムアウト {len(r['timeout'])}")
+    for midi, msg in r["failed"] + r["timeout"]:
+        print(f"  {midi}: {msg}")
+    return 1 if r["failed"] or r["timeout"] else 0
+
 def DRV_DEFAULT():
     return "dsound"  # Windows既定
 
 if __name__ == "__main__":
+    if "--batch" in sys.argv[1:]:  # それ以外の引数（「プログラムから開く」の .mid など）は GUI を開く
+        sys.exit(batch_main(sys.argv[1:]))
     root = tk.Tk()
     app = SimpleMIDIPlayer200Design(root)
+    root.protocol("WM_DELETE_WINDOW", app.on_close)
     root.mainloop()
@@ -4,13 +4,12 @@ import sounddevice as sd
 import numpy as np
 import threading
 import subprocess
-import matplotlib
 import mido
 import time
-
-matplotlib.use("TkAgg")
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.pyplot as plt
+import os
+import hashlib
+import tempfile
+from waveform_common import AudioRingBuffer, BlitRenderer, CanvasRenderer
 
 GM_PROGRAM_NAMES = [
     "Acoustic Grand Piano", "Bright Acoustic Piano", "Electric Grand Piano", "Honky-tonk Piano",
@@ -39,6 +38,206 @@ GM_PROGRAM_NAMES = [
     "Breath Noise", "Seashore", "Bird Tweet", "Telephone Ring", "Helicopter", "Applause", "Gunshot"
 ]
 
+NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
+def note_name(note):
+    return f"{NOTE_NAMES[note % 12]}{note // 12 - 1}"
+
+
+class NoteTable:
+    """
+    読み込み時に1回だけ作る「時刻 → 鳴っているノート」の表。
+    ノートごとの発音・消音時刻（秒、テンポ換算済み）と音高を、発音時刻順の numpy 配列で持つ。
+    引くときは searchsorted で「最長ノート長ぶん前から今まで」に発音したノートだけを切り出し、消音時刻で絞る。
+    LONG_NOTE_SEC より長いノートは別に持つ（長く伸ばした1音のせいで切り出す範囲が広がらないように）。
+    """
+    LONG_NOTE_SEC = 4.0
+
+    def __init__(self, onsets, offsets, pitches):
+        order = np.argsort(onsets, kind="stable")
+        onsets, offsets, pitches = onsets[order], offsets[order], pitches[order]
+        long = offsets - onsets > self.LONG_NOTE_SEC
+        self.onsets, self.offsets, self.pitches = onsets[~long], offsets[~long], pitches[~long]
+        self.long_onsets, self.long_offsets, self.long_pitches = onsets[long], offsets[long], pitches[long]
+        self.max_len = float((self.offsets - self.onsets).max()) if len(self.onsets) else 0.0
+
+    @classmethod
+    def from_midi(cls, midi):
+        now = 0.0
+        pending = {}  # (ch, note) -> 消音待ちの発音時刻（古い順）
+        onsets, offsets, pitches = [], [], []
+        for msg in midi:  # mido の再生順イテレーションは msg.time がテンポ換算済みの秒
+            now += msg.time
+            if msg.type == "note_on" and msg.velocity > 0:
+                pending.setdefault((msg.channel, msg.note), []).append(now)
+            elif msg.type in ("note_on", "note_off"):
+                starts = pending.get((msg.channel, msg.note))
+                if starts:
+                    onsets.append(starts.pop(0))
+                    offsets.append(now)
+                    pitches.append(msg.note)
+        for (_, note), starts in pending.items():  # 消音の無いノートは曲の終わりまで鳴っている扱い
+            onsets.extend(starts)
+            offsets.extend([now] * len(starts))
+            pitches.extend([note] * len(starts))
+        return cls(np.array(onsets, dtype=np.float64), np.array(offsets, dtype=np.float64),
+                   np.array(pitches, dtype=np.int16))
+
+    def at(self, sec):
+        """sec 秒に鳴っているノート番号を音高順に返す。"""
+        hi = np.searchsorted(self.onsets, sec, side="right")
+        lo = np.searchsorted(self.onsets, sec - self.max_len, side="left")
+        notes = self.pitches[lo:hi][self.offsets[lo:hi] > sec]
+        held = self.long_pitches[(self.long_onsets <= sec) & (self.long_offsets > sec)]
+        return np.unique(np.concatenate([notes, held])).tolist()
+
+SAMPLE_RATE = 44100
+PLOT_BACKEND = "canvas"  # "canvas"（tk.Canvas に直接描画）または "matplotlib"
+PLOT_BACKENDS = ["canvas", "matplotlib"]
+SOURCE_MODE = "offline"  # "offline"（先に PCM へレンダリング）または "capture"（録音デバイスから取り込み）
+SOURCE_MODES = ["offline", "capture"]
+PCM_CACHE_KEEP = 4  # テンポラリに残すレンダリング結果（mhp_pcm_*.raw）の数。古いものから消す
+VIEW_SPANS = {"20ms": 0.02, "100ms": 0.1, "1秒": 1.0, "10秒": 10.0, "1分": 60.0, "10分": 600.0}  # 表示幅
+plt = None  # matplotlib を選んだときだけ読み込む
+
+class PeakPyramid:
+    """
+    波形の min/max/二乗和をブロックごとに持つ多段ピラミッド。段 k のブロックは BLOCK * 2**k サンプル。
+    append() で届いた分だけ積み上げていくので、20ms の拡大でも10分の全体表示でも
+    view() の計算量は画素数ぶんで済む。オフライン音源は append() に配列ごと渡せばよい。
+    """
+    BLOCK = 64
+    LEVELS = 16  # 最上段のブロックは約47秒（44.1kHz）
+
+    def __init__(self):
+        self.mins = [np.zeros(256, dtype=np.float32) for _ in range(self.LEVELS)]
+        self.maxs = [np.zeros(256, dtype=np.float32) for _ in range(self.LEVELS)]
+        self.sqs = [np.zeros(256, dtype=np.float64) for _ in range(self.LEVELS)]
+        self.counts = [0] * self.LEVELS
+        self.carry = np.zeros(0, dtype=np.float32)  # ブロックに満たない端数
+        self.total = 0
+
+    def _put(self, k, mn, mx, sq):
+        c = self.counts[k]
+        n = c + len(mn)
+        if n > len(self.mins[k]):
+            size = max(n, len(self.mins[k]) * 2)
+            for arrs in (self.mins, self.maxs, self.sqs):
+                grown = np.zeros(size, dtype=arrs[k].dtype)
+                grown[:c] = arrs[k][:c]
+                arrs[k] = grown
+        self.mins[k][c:n] = mn
+        self.maxs[k][c:n] = mx
+        self.sqs[k][c:n] = sq
+        self.counts[k] = n
+
+    def append(self, x):
+        self.total += len(x)
+        if len(self.carry):
+            x = np.concatenate([self.carry, x])
+        n = len(x) // self.BLOCK * self.BLOCK
+        self.carry = np.array(x[n:], dtype=np.float32)
+        if not n:
+            return
+        blk = x[:n].reshape(-1, self.BLOCK)
+        self._put(0, blk.min(axis=1), blk.max(axis=1), np.square(blk, dtype=np.float64).sum(axis=1))
+        # 下の段で2つ揃ったブロックから上の段を作る
+        for k in range(1, self.LEVELS):
+            done = self.counts[k] * 2
+            m = (self.counts[k - 1] - done) // 2 * 2
+            if m <= 0:
+                break
+            sl = slice(done, done + m)
+            self._put(k, self.mins[k - 1][sl].reshape(-1, 2).min(axis=1),
+                      self.maxs[k - 1][sl].reshape(-1, 2).max(axis=1),
+                      self.sqs[k - 1][sl].reshape(-1, 2).sum(axis=1))
+
+    def view(self, start, stop, width):
+        """
+        サンプル区間 [start, stop) を width 列に割り、各列の (min, max, rms) を返す。
+        まだ無い区間（start < 0 など）の列は 0。1列が BLOCK サンプル未満なら None（生データで描くこと）。
+        """
+        spp = (stop - start) / width
+        if spp < self.BLOCK:
+            return None
+        k = min(int(np.log2(spp / self.BLOCK)), self.LEVELS - 1)
+        bs = self.BLOCK << k
+        n = self.counts[k]
+        mins = np.zeros(width, dtype=np.float32)
+        maxs = np.zeros(width, dtype=np.float32)
+        rms = np.zeros(width, dtype=np.float32)
+        edges = np.floor((start + np.arange(width + 1) * spp) / bs).astype(np.int64)
+        lo = edges[:-1]
+        hi = np.minimum(edges[1:], n)
+        valid = np.flatnonzero((lo >= 0) & (lo < hi))
+        if not len(valid):
+            return mins, maxs, rms
+        idx = lo[valid]
+        end = hi[valid[-1]]
+        mins[valid] = np.minimum.reduceat(self.mins[k][:end], idx)
+        maxs[valid] = np.maximum.reduceat(self.maxs[k][:end], idx)
+        nblk = np.diff(np.append(idx, end))
+        rms[valid] = np.sqrt(np.add.reduceat(self.sqs[k][:end], idx) / (nblk * bs))
+        return mins, maxs, rms
+
+
+def render_pcm(midi_path, sf2_path, rate=SAMPLE_RATE):
+    """
+    fluidsynth -F で MIDI を実時間より速く s16 ステレオの raw に書き出し、そのパスを返す。
+    MIDI・SoundFont・レートが同じならテンポラリのキャッシュをそのまま使う。
+    """
+    ms, ss = os.stat(midi_path), os.stat(sf2_path)
+    key = "|".join(map(str, (os.path.abspath(midi_path), ms.st_size, ms.st_mtime_ns,
+                             os.path.abspath(sf2_path), ss.st_size, ss.st_mtime_ns, rate)))
+    path = os.path.join(tempfile.gettempdir(), f"mhp_pcm_{hashlib.sha1(key.encode()).hexdigest()[:16]}.raw")
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        os.utime(path)  # 使った順に残す
+        return path
+    fd, tmp = tempfile.mkstemp(prefix="mhp_pcm_", suffix=".part")  # 同時に2つ走っても混ざらない
+    os.close(fd)
+    try:
+        r = subprocess.run(["fluidsynth", "-ni", "-F", tmp, "-T", "raw", "-O", "s16", "-r", str(rate), sf2_path, midi_path],
+                           capture_output=True, text=True)
+        if r.returncode != 0 or os.path.getsize(tmp) == 0:
+            raise RuntimeError(r.stderr.strip() or "fluidsynth のレンダリングに失敗しました")
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    prune_pcm_cache(keep=PCM_CACHE_KEEP)
+    return path
+
+
+def prune_pcm_cache(keep=PCM_CACHE_KEEP):
+    """テンポラリの mhp_pcm_*.raw を新しい順に keep 個だけ残す（開いたままで消せないものは次回）。"""
+    d = tempfile.gettempdir()
+    files = [os.path.join(d, f) for f in os.listdir(d) if f.startswith("mhp_pcm_") and f.endswith(".raw")]
+    files.sort(key=lambda p: os.path.getmtime(p), reverse=True)
+    for p in files[keep:]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+class PcmCache:
+    """render_pcm() の出力（s16 ステレオ）をメモリマップで開いたもの。読み込みはページ単位で必要な分だけ。"""
+    def __init__(self, path, rate=SAMPLE_RATE):
+        self.path = path
+        self.rate = rate
+        self.data = np.memmap(path, dtype=np.int16, mode="r").reshape(-1, 2)
+        self.frames = len(self.data)
+
+    def mono(self, start, stop):
+        return self.data[max(start, 0):stop].mean(axis=1, dtype=np.float32) / 32768.0
+
+    def build_pyramid(self, chunk=SAMPLE_RATE * 10):
+        pyramid = PeakPyramid()
+        for i in range(0, self.frames, chunk):
+            pyramid.append(self.mono(i, i + chunk))
+        return pyramid
+
+
 class MidiWaveformApp:
     def __init__(self, root):
         self.root = root
@@ -49,7 +248,24 @@ class MidiWaveformApp:
         self.device_index = tk.IntVar(value=0)
         self.volume = 0
         self.channel_programs = {}  # チャンネル: プログラム番号
+        self.note_table = None
+        self.parse_gen = 0         # ファイルを選ぶたびに進める。古い読み込み結果は捨てる
+        self.play_t0 = 0.0  # 録音モードの再生開始時刻（perf_counter）
         self.soundfont_path = "soundfont.sf2"
+        self.ring = AudioRingBuffer()
+        self.pyramid = PeakPyramid()
+        self.fed = 0  # ピラミッドに積んだところまでの ring.total
+        self.view_span = tk.StringVar(value="20ms")
+        self.stream = None
+        self.source_mode = tk.StringVar(value=SOURCE_MODE)
+        self.pcm = None            # オフライン時のレンダリング結果
+        self.song_pyramid = None   # 曲全体のピラミッド
+        self.play_pos = 0          # オフライン再生位置（フレーム）
+        self.seek_to = None
+        self.render_gen = 0        # start/stop のたびに進める。古いレンダリング結果では再生しない
+        self.plot_backend = tk.StringVar(value=PLOT_BACKEND)
+        self.plot_widget = None
+        self.fig = None
 
         self.create_widgets()
         self.setup_plot()
@@ -57,12 +273,20 @@ class MidiWaveformApp:
     def create_widgets(self):
         tk.Button(self.root, text="🔍 MIDIファイル選択", command=self.select_midi).pack(pady=5)
 
+        tk.Label(self.root, text="🎧 波形の取得：").pack()
+        tk.OptionMenu(self.root, self.source_mode, *SOURCE_MODES).pack(pady=5)
+
         tk.Label(self.root, text="🎧 録音デバイス番号：").pack()
         self.device_entry = tk.Entry(self.root, textvariable=self.device_index)
         self.device_entry.pack(pady=5)
 
         tk.Button(self.root, text="🎼 SoundFontを選択", command=self.select_soundfont).pack(pady=5)
 
+        tk.Label(self.root, text="📈 描画方式：").pack()
+        tk.OptionMenu(self.root, self.plot_backend, *PLOT_BACKENDS, command=self.setup_plot).pack(pady=5)
+        tk.Label(self.root, text="🔎 表示幅：").pack()
+        tk.OptionMenu(self.root, self.view_span, *VIEW_SPANS).pack(pady=5)
+
         tk.Button(self.root, text="▶ 再生開始", command=self.start).pack(pady=5)
         tk.Button(self.root, text="■ 停止", command=self.stop).pack(pady=5)
 
@@ -73,16 +297,41 @@ class MidiWaveformApp:
         self.volume_rect = self.volume_bar.create_rectangle(0, 0, 0, 20, fill="green")
         self.volume_bar.pack(pady=5)
 
+        # 曲全体の波形（オフライン時）。クリック・ドラッグで再生位置を移動
+        self.overview = tk.Canvas(self.root, width=600, height=60, bg="black")
+        self.overview_head = self.overview.create_line(0, 0, 0, 60, fill="red")
+        self.overview.bind("<Button-1>", self.scrub)
+        self.overview.bind("<B1-Motion>", self.scrub)
+        self.overview.pack(pady=5)
+
         self.instrument_label = tk.Label(self.root, text="🎻 使用楽器:")
         self.instrument_label.pack(pady=5)
 
-    def setup_plot(self):
-        self.fig, self.ax = plt.subplots(figsize=(6, 3))
-        self.ax.set_ylim(-1, 1)
-        self.line, = self.ax.plot(np.zeros(1024))
-        self.canvas = FigureCanvasTkAgg(self.fig, master=self.root)
-        self.canvas.get_tk_widget().pack()
-        self.canvas.draw()
+    def setup_plot(self, *_):
+        global plt
+        if self.plot_widget is not None:
+            self.plot_widget.destroy()
+        if self.fig is not None:
+            plt.close(self.fig)
+            self.fig = None
+        if self.plot_backend.get() == "matplotlib":
+            # matplotlib は選ばれたときだけ読み込む（import だけで起動が重くなるため）
+            import matplotlib
+            matplotlib.use("TkAgg")
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            import matplotlib.pyplot as plt
+            self.fig, self.ax = plt.subplots(figsize=(6, 3))
+            self.ax.set_ylim(-1, 1)
+            self.ax.set_xlim(0, 1)
+            self.line, = self.ax.plot(np.linspace(0, 1, 1024), np.zeros(1024))
+            self.canvas = FigureCanvasTkAgg(self.fig, master=self.root)
+            self.plot_widget = self.canvas.get_tk_widget()
+            self.renderer = BlitRenderer(self.fig, self.ax, self.line)
+            self.canvas.draw()
+        else:
+            self.renderer = CanvasRenderer(self.root)
+            self.plot_widget = self.renderer.canvas
+        self.plot_widget.pack()
 
     def select_midi(self):
         self.midi_path = filedialog.askopenfilename(filetypes=[("MIDI files", "*.mid *.midi")])
@@ -97,29 +346,154 @@ class MidiWaveformApp:
 
     def parse_instruments(self):
         self.channel_programs = {}
+        self.note_table = None
+        self.parse_gen += 1
+        self.instrument_label.config(text="🎻 使用楽器: ⏳ 読み込み中…")
+        threading.Thread(target=self.load_midi_info, args=(self.midi_path, self.parse_gen), daemon=True).start()
+
+    def load_midi_info(self, path, gen):
+        # 別スレッド：楽器一覧とノート表の作成（音数の多いファイルでは数秒かかる）。Tk には after で戻す
         try:
-            midi = mido.MidiFile(self.midi_path)
+            midi = mido.MidiFile(path)
+            programs = {}
             for msg in midi:
                 if msg.type == "program_change":
-                    self.channel_programs[msg.channel] = msg.program
-            display = "\n".join(
-                [f"Ch{ch+1}: Program {prog} - {GM_PROGRAM_NAMES[prog]}" for ch, prog in self.channel_programs.items()]
-            )
-            self.instrument_label.config(text=f"🎻 使用楽器:\n{display}")
+                    programs[msg.channel] = msg.program
+            table = NoteTable.from_midi(midi)
         except Exception as e:
-            self.instrument_label.config(text=f"⚠ 楽器情報の取得に失敗: {e}")
+            text = f"⚠ 楽器情報の取得に失敗: {e}"
+            def show():
+                if gen == self.parse_gen:
+                    self.instrument_label.config(text=text)
+            self.root.after(0, show)
+            return
+        self.root.after(0, lambda: self.show_midi_info(gen, programs, table))
+
+    def show_midi_info(self, gen, programs, table):
+        if gen != self.parse_gen:
+            return  # その後別のファイルが選ばれた
+        self.channel_programs = programs
+        self.note_table = table
+        display = "\n".join(
+            [f"Ch{ch+1}: Program {prog} - {GM_PROGRAM_NAMES[prog]}" for ch, prog in programs.items()]
+        )
+        self.instrument_label.config(text=f"🎻 使用楽器:\n{display}")
 
     def start(self):
         if not hasattr(self, "midi_path"):
             print("⚠ MIDIファイルが選択されていません")
             return
+        self.stop()
+        if self.source_mode.get() == "offline":
+            self.note_label.config(text="⏳ レンダリング中…")
+            threading.Thread(target=self.prepare_offline, args=(self.render_gen,), daemon=True).start()
+            return
+        self.pcm = None
+        try:
+            self.open_stream()
+        except Exception as e:
+            print(f"⚠ 録音デバイスを開けません: {e}")
+            return
+        self.pyramid = PeakPyramid()
+        self.fed = self.ring.total
         self.running = True
+        self.play_t0 = time.perf_counter()
         threading.Thread(target=self.play_midi, daemon=True).start()
         self.update_plot()
         self.update_note()
 
     def stop(self):
         self.running = False
+        self.render_gen += 1  # レンダリング中なら、終わっても再生しない
+        self.close_stream()
+
+    def prepare_offline(self, gen):
+        # 別スレッド：レンダリングと全体ピラミッドの作成。Tk には after で戻す
+        try:
+            pcm = PcmCache(render_pcm(self.midi_path, self.soundfont_path))
+            pyramid = pcm.build_pyramid()
+        except Exception as e:
+            msg = f"⚠ レンダリング失敗: {e}"
+            def show():
+                if gen == self.render_gen:
+                    self.note_label.config(text=msg)
+            self.root.after(0, show)
+            return
+        self.root.after(0, lambda: self.start_offline(gen, pcm, pyramid))
+
+    def start_offline(self, gen, pcm, pyramid):
+        if gen != self.render_gen:
+            return  # その後 stop / start された
+        self.close_stream()
+        self.pcm = pcm
+        self.song_pyramid = pyramid
+        self.play_pos = 0
+        self.seek_to = None
+        self.draw_overview()
+        try:
+            self.stream = sd.OutputStream(samplerate=pcm.rate, channels=2, dtype="int16",
+                                          callback=self.output_callback)
+            self.stream.start()
+        except Exception as e:
+            print(f"⚠ 再生デバイスを開けません: {e}")
+            return
+        self.running = True
+        self.update_plot()
+        self.update_note()
+
+    def output_callback(self, outdata, frames, time_info, status):
+        # PortAudio スレッド：メモリマップから切り出して流すだけ
+        if self.seek_to is not None:
+            self.play_pos, self.seek_to = self.seek_to, None
+        chunk = self.pcm.data[self.play_pos:self.play_pos + frames]
+        n = len(chunk)
+        outdata[:n] = chunk
+        outdata[n:] = 0
+        self.play_pos += n
+        self.ring.write(chunk.mean(axis=1, dtype=np.float32) / 32768.0)
+        if n < frames:
+            raise sd.CallbackStop
+
+    def draw_overview(self):
+        self.overview.delete("wave")
+        w = int(self.overview["width"])
+        h = int(self.overview["height"])
+        peaks = self.song_pyramid.view(0, self.pcm.frames, w)
+        if peaks is None:
+            return
+        mins, maxs, _ = peaks
+        xs = np.arange(w)
+        top = np.column_stack([xs, (1 - maxs) * h / 2]).ravel()
+        bottom = np.column_stack([xs[::-1], (1 - mins[::-1]) * h / 2]).ravel()
+        self.overview.create_polygon(np.concatenate([top, bottom]).tolist(), fill="#88C0D0", tags="wave")
+        self.overview.tag_raise(self.overview_head)
+
+    def scrub(self, event):
+        if self.pcm is None:
+            return
+        w = int(self.overview["width"])
+        self.seek_to = int(min(max(event.x / w, 0), 1) * self.pcm.frames)
+
+    def open_stream(self):
+        """録音は InputStream のコールバックで切れ目なくリングバッファへ。"""
+        self.close_stream()
+        self.stream = sd.InputStream(samplerate=SAMPLE_RATE, channels=1, dtype="float32",
+                                     blocksize=256, device=self.device_index.get(),
+                                     callback=self.audio_callback)
+        self.stream.start()
+
+    def close_stream(self):
+        if self.stream is not None:
+            try:
+                self.stream.stop()
+                self.stream.close()
+            except Exception:
+                pass
+            self.stream = None
+
+    def audio_callback(self, indata, frames, time_info, status):
+        # PortAudio スレッド：書き込むだけで何も待たない
+        self.ring.write(indata[:, 0])
 
     def play_midi(self):
         subprocess.run(["fluidsynth", "-ni", self.soundfont_path, self.midi_path])
@@ -127,29 +501,68 @@ class MidiWaveformApp:
     def update_plot(self):
         if not self.running:
             return
+        if self.pcm is not None and self.stream is not None and not self.stream.active:
+            self.stop()  # 曲の終わりまで流れた
+            return
+        delay = 16  # 約60FPS相当
         try:
-            data = sd.rec(512, samplerate=44100, channels=1, dtype="float32", device=self.device_index.get())
-            sd.wait()
-            self.line.set_ydata(np.interp(np.linspace(0, len(data)-1, 1024), np.arange(len(data)), data.flatten()))
-            self.canvas.draw()
+            delay = self.renderer.draw(self.waveform_view())
+            data = self.ring.latest(512)
             vol = min(max(np.abs(data).max(), 0), 1)
             self.volume_bar.coords(self.volume_rect, 0, 0, 200 * vol, 20)
+            if self.pcm is not None:
+                x = int(self.overview["width"]) * self.play_pos / max(self.pcm.frames, 1)
+                self.overview.coords(self.overview_head, x, 0, x, int(self.overview["height"]))
         except Exception as e:
             print(f"⚠ 波形描画エラー: {e}")
-        self.root.after(16, self.update_plot)  # 約60FPS相当
+        self.root.after(delay, self.update_plot)
+
+    def feed_pyramid(self):
+        """前回から録音された分をピラミッドに積む。"""
+        total = self.ring.total
+        new = total - self.fed
+        n = min(new, self.ring.size // 2)
+        if new > n:
+            self.pyramid.append(np.zeros(new - n, dtype=np.float32))  # 追いつけなかった分は無音扱いで時間軸を保つ
+        if n:
+            self.pyramid.append(self.ring.ending_at(total, n))
+        self.fed = total
+        return total
+
+    def waveform_view(self):
+        """表示幅ぶんの波形。短ければ生サンプル、長ければピラミッドの min/max を交互に並べたもの。"""
+        n = int(VIEW_SPANS[self.view_span.get()] * SAMPLE_RATE)
+        width = self.renderer.width
+        if self.pcm is not None:
+            # オフライン：曲全体のピラミッドから再生位置までを切り出す
+            end = self.play_pos
+            peaks = self.song_pyramid.view(end - n, end, width)
+            if peaks is None:
+                raw = self.pcm.mono(end - n, end)
+                return raw if len(raw) > 1 else np.zeros(2, dtype=np.float32)
+        else:
+            total = self.feed_pyramid()
+            peaks = self.pyramid.view(total - n, total, width)
+            if peaks is None:
+                return self.ring.ending_at(total, min(n, self.ring.size // 2))
+        mins, maxs, _ = peaks
+        ydata = np.empty(width * 2, dtype=np.float32)
+        ydata[0::2] = mins
+        ydata[1::2] = maxs
+        return ydata
+
+    def playback_seconds(self):
+        if self.pcm is not None:
+            return self.play_pos / self.pcm.rate
+        return time.perf_counter() - self.play_t0
 
     def update_note(self):
-        if not self.running or not hasattr(self, "midi_path"):
+        if not self.running:
             return
-        try:
-            midi = mido.MidiFile(self.midi_path)
-            notes = [msg.note for msg in midi if msg.type == "note_on"]
-            if notes:
-                note = notes[int(time.time() * 2) % len(notes)]
-                self.note_label.config(text=f"♪ ノート: {mido.get_note_name(note)}")
-        except Exception as e:
-            self.note_label.config(text=f"⚠ ノート取得エラー: {e}")
-        self.root.after(1000, self.update_note)
+        if self.note_table is not None:  # 読み込みが終わるまでは表示しない
+            notes = self.note_table.at(self.playback_seconds())
+            self.note_label.config(text="♪ ノート: " + " ".join(note_name(n) for n in notes[:8]))
+        self.root.after(50, self.update_note)
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -4,13 +4,15 @@ import sounddevice as sd
 import numpy as np
 import threading
 import subprocess
-import matplotlib
-matplotlib.use("TkAgg")
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.pyplot as plt
 import mido
+from waveform_common import AudioRingBuffer, BlitRenderer, CanvasRenderer
 
 SOUNDFONT_FILE = "soundfont.sf2"  # 任意のSoundFontに変更
+SAMPLE_RATE = 44100
+WINDOW = 1024  # 波形表示のサンプル数
+PLOT_BACKEND = "canvas"  # "canvas"（tk.Canvas に直接描画）または "matplotlib"
+PLOT_BACKENDS = ["canvas", "matplotlib"]
+plt = None  # matplotlib を選んだときだけ読み込む
 
 class MidiWaveformApp:
     def __init__(self, root):
@@ -22,6 +24,11 @@ class MidiWaveformApp:
         self.midi_path = None
         self.note_label = tk.StringVar()
         self.volume_level = tk.DoubleVar()
+        self.ring = AudioRingBuffer()
+        self.stream = None
+        self.plot_backend = tk.StringVar(value=PLOT_BACKEND)
+        self.plot_widget = None
+        self.fig = None
 
         self.create_widgets()
         self.setup_plot()
@@ -32,6 +39,9 @@ class MidiWaveformApp:
         tk.Label(self.root, text="🎧 録音デバイス番号：").pack()
         tk.Entry(self.root, textvariable=self.device_index).pack(pady=5)
 
+        tk.Label(self.root, text="📈 描画方式：").pack()
+        tk.OptionMenu(self.root, self.plot_backend, *PLOT_BACKENDS, command=self.setup_plot).pack(pady=5)
+
         tk.Button(self.root, text="▶ 再生開始", command=self.start).pack(pady=5)
         tk.Button(self.root, text="■ 停止", command=self.stop).pack(pady=5)
 
@@ -39,13 +49,30 @@ class MidiWaveformApp:
         tk.Label(self.root, text="🔊 音量").pack()
         tk.Scale(self.root, variable=self.volume_level, from_=0, to=1, orient=tk.HORIZONTAL, resolution=0.01, length=300, state="disabled").pack()
 
-    def setup_plot(self):
-        self.fig, self.ax = plt.subplots(figsize=(6, 3))
-        self.ax.set_ylim(-1, 1)
-        self.line, = self.ax.plot(np.zeros(1024))
-        self.canvas = FigureCanvasTkAgg(self.fig, master=self.root)
-        self.canvas.get_tk_widget().pack()
-        self.canvas.draw()
+    def setup_plot(self, *_):
+        global plt
+        if self.plot_widget is not None:
+            self.plot_widget.destroy()
+        if self.fig is not None:
+            plt.close(self.fig)
+            self.fig = None
+        if self.plot_backend.get() == "matplotlib":
+            # matplotlib は選ばれたときだけ読み込む（import だけで起動が重くなるため）
+            import matplotlib
+            matplotlib.use("TkAgg")
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            import matplotlib.pyplot as plt
+            self.fig, self.ax = plt.subplots(figsize=(6, 3))
+            self.ax.set_ylim(-1, 1)
+            self.line, = self.ax.plot(np.zeros(WINDOW))
+            self.canvas = FigureCanvasTkAgg(self.fig, master=self.root)
+            self.plot_widget = self.canvas.get_tk_widget()
+            self.renderer = BlitRenderer(self.fig, self.ax, self.line)
+            self.canvas.draw()
+        else:
+            self.renderer = CanvasRenderer(self.root)
+            self.plot_widget = self.renderer.canvas
+        self.plot_widget.pack()
 
     def select_midi(self):
         self.midi_path = filedialog.askopenfilename(filetypes=[("MIDI files", "*.mid *.midi")])
@@ -54,6 +81,11 @@ class MidiWaveformApp:
         if not self.midi_path:
             print("⚠ MIDIファイルが選択されていません")
             return
+        try:
+            self.open_stream()
+        except Exception as e:
+            print(f"⚠ 録音デバイスを開けません: {e}")
+            return
         self.running = True
         threading.Thread(target=self.play_midi, daemon=True).start()
         threading.Thread(target=self.analyze_midi, daemon=True).start()
@@ -61,6 +93,28 @@ class MidiWaveformApp:
 
     def stop(self):
         self.running = False
+        self.close_stream()
+
+    def open_stream(self):
+        """録音は InputStream のコールバックで切れ目なくリングバッファへ。"""
+        self.close_stream()
+        self.stream = sd.InputStream(samplerate=SAMPLE_RATE, channels=1, dtype="float32",
+                                     blocksize=256, device=self.device_index.get(),
+                                     callback=self.audio_callback)
+        self.stream.start()
+
+    def close_stream(self):
+        if self.stream is not None:
+            try:
+                self.stream.stop()
+                self.stream.close()
+            except Exception:
+                pass
+            self.stream = None
+
+    def audio_callback(self, indata, frames, time_info, status):
+        # PortAudio スレッド：書き込むだけで何も待たない
+        self.ring.write(indata[:, 0])
 
     def play_midi(self):
         subprocess.run(["fluidsynth", "-ni", SOUNDFONT_FILE, self.midi_path])
@@ -68,15 +122,14 @@ class MidiWaveformApp:
     def update_plot(self):
         if not self.running:
             return
+        delay = 16  # 約60FPS
         try:
-            data = sd.rec(1024, samplerate=44100, channels=1, dtype="float32", device=self.device_index.get())
-            sd.wait()
-            self.line.set_ydata(data.flatten())
-            self.volume_level.set(np.max(np.abs(data)))
-            self.canvas.draw()
+            data = self.ring.latest(WINDOW)
+            delay = self.renderer.draw(data)
+            self.volume_level.set(float(np.max(np.abs(data))))
         except Exception as e:
             print(f"⚠ 波形描画エラー: {e}")
-        self.root.after(16, self.update_plot)  # 約60FPS
+        self.root.after(delay, self.update_plot)
 
     def analyze_midi(self):
         try:
@@ -0,0 +1,145 @@
+"""
+波形表示スクリプト（midi_waveform_gui.py / midi_gui_instruments.py / midi_waveform_player_debug.py）で共有する部品。
+リングバッファ・フレーム間隔の調整・matplotlib / tk.Canvas への描画をまとめる。
+"""
+import tkinter as tk
+import numpy as np
+import time
+
+SAMPLE_RATE = 44100
+
+
+class AudioRingBuffer:
+    """
+    sd.InputStream のコールバック（PortAudio スレッド）だけが書き込み、Tk 側は最新の区間を読む。
+    同じデータを [i] と [i + size] の2か所に書く（ミラー）ので、最新 n サンプルは
+    コピーもロックも無しに連続したビューで取り出せる。
+    """
+    def __init__(self, size=SAMPLE_RATE * 2):
+        self.size = size
+        self.buf = np.zeros(size * 2, dtype=np.float32)
+        self.pos = 0    # 次に書く位置 (0..size-1)
+        self.total = 0  # これまでに書いたサンプル数
+
+    def write(self, x):
+        size = self.size
+        n = len(x)
+        p = self.pos
+        self.total += n
+        if n > size:
+            # 入りきらない分は捨てるが、位置と total は捨てた分も進める（total % size == pos を保つ）
+            p = (p + n - size) % size
+            x = x[-size:]
+            n = size
+        first = min(n, size - p)
+        self.buf[p:p + first] = x[:first]
+        self.buf[p + size:p + size + first] = x[:first]
+        rest = n - first
+        if rest:
+            self.buf[:rest] = x[first:]
+            self.buf[size:size + rest] = x[first:]
+        self.pos = (p + n) % size
+
+    def latest(self, n):
+        """最新 n サンプルのビュー（n <= size）。"""
+        end = self.pos + self.size
+        return self.buf[end - n:end]
+
+    def ending_at(self, total, n):
+        """書き込み通算 total サンプル目で終わる n サンプルのビュー（読む間に上書きされない範囲で）。"""
+        end = total % self.size + self.size
+        return self.buf[end - n:end]
+
+
+class FrameGovernor:
+    """描画にかかった時間を測って次のフレーム間隔を決める（上限 fps、重ければ min_fps まで間引く）。"""
+    def __init__(self, fps=60, min_fps=15, budget=0.5):
+        self.min_interval = 1.0 / fps
+        self.max_interval = 1.0 / min_fps
+        self.budget = budget  # 1フレームのうち描画に使ってよい割合
+        self.cost = 0.0       # 描画時間の移動平均（秒）
+
+    def next_delay(self, cost):
+        """今回の描画時間(秒)から、次のフレームまでの待ち時間(ms)を返す。"""
+        self.cost = cost if not self.cost else self.cost * 0.8 + cost * 0.2
+        interval = min(max(self.cost / self.budget, self.min_interval), self.max_interval)
+        return max(1, int((interval - cost) * 1000))
+
+
+class BlitRenderer:
+    """
+    matplotlib 用。背景（軸・目盛り）は描画イベントのたびに1回だけキャッシュし、毎フレームは線だけ blit する。
+    """
+    def __init__(self, fig, ax, line, fps=60, min_fps=15, budget=0.5):
+        self.width = int(fig.bbox.width)
+        self.fig = fig
+        self.ax = ax
+        self.line = line
+        self.canvas = fig.canvas
+        self.background = None
+        self.governor = FrameGovernor(fps, min_fps, budget)
+        line.set_animated(True)
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+
+    def _on_draw(self, event):
+        # リサイズ等でフル描画されたら背景を取り直す
+        self.width = int(self.fig.bbox.width)
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.ax.draw_artist(self.line)
+
+    def draw(self, ydata):
+        """線を更新して blit し、次のフレームまでの待ち時間(ms)を返す。"""
+        t0 = time.perf_counter()
+        if len(ydata) == len(self.line.get_xdata()):
+            self.line.set_ydata(ydata)
+        else:
+            # 点数が変わったら x を軸の表示範囲に均等に並べ直す
+            x0, x1 = self.ax.get_xlim()
+            self.line.set_data(np.linspace(x0, x1, len(ydata)), ydata)
+        if self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.line)
+            self.canvas.blit(self.fig.bbox)
+        return self.governor.next_delay(time.perf_counter() - t0)
+
+
+def minmax_decimate(data, width):
+    """data を width 列に分け、各列の最小値・最大値を交互に並べて返す（長さ 2*width）。"""
+    if len(data) <= width:
+        return data
+    idx = np.arange(width) * len(data) // width
+    out = np.empty(width * 2, dtype=data.dtype)
+    out[0::2] = np.minimum.reduceat(data, idx)
+    out[1::2] = np.maximum.reduceat(data, idx)
+    return out
+
+
+class CanvasRenderer:
+    """
+    tk.Canvas に直接描く。折れ線は1本だけ作っておき、毎フレーム coords() で座標を差し替える。
+    サンプル数が画面幅より多いときは min/max で間引くので、ピークは欠けない。
+    """
+    def __init__(self, master, width=600, height=300, fps=60, min_fps=15, budget=0.5):
+        self.width = width
+        self.height = height
+        self.canvas = tk.Canvas(master, width=width, height=height, bg="white", highlightthickness=0)
+        self.canvas.create_line(0, height / 2, width, height / 2, fill="#dddddd")
+        self.line = self.canvas.create_line(0, height / 2, width, height / 2, fill="#1f77b4")
+        self.governor = FrameGovernor(fps, min_fps, budget)
+        self.canvas.bind("<Configure>", self._on_resize)
+
+    def _on_resize(self, event):
+        self.width = max(event.width, 2)
+        self.height = max(event.height, 2)
+
+    def draw(self, ydata):
+        """線を更新し、次のフレームまでの待ち時間(ms)を返す。"""
+        t0 = time.perf_counter()
+        ys = minmax_decimate(ydata, self.width)
+        pts = np.empty(len(ys) * 2)
+        pts[0::2] = np.linspace(0, self.width - 1, len(ys))
+        pts[1::2] = (1.0 - np.clip(ys, -1.0, 1.0)) * (self.height / 2)
+        self.canvas.coords(self.line, pts.tolist())
+        return self.governor.next_delay(time.perf_counter() - t0)